@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark parsing of ONVIF responses: responses per second.
+    before - BeautifulSoup html.parser (OnvifCam up to pxml module)
+    after - pxml (xml.etree)
+Responses are the fixtures in benchmarks/fixtures.
+Run: python3 benchmarks/onvif_parser.py [repeat]
+"""
+
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recordclient'))
+
+import pxml
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name + '.xml'), 'rb') as f:
+        return f.read()
+
+
+def legacy_node_recursively(rt, res):
+    """
+    The former OnvifCam._get_all_node_recursively
+    """
+    try:
+        name = (rt.name).split(':')[1]
+    except:
+        name = rt.name
+    if len(list(rt.findChildren())) == 0:
+        res[name] = rt.text
+    else:
+        res[name] = {}
+        for i in rt.contents:
+            legacy_node_recursively(i, res[name])
+
+
+def legacy_extractors():
+    from bs4 import BeautifulSoup
+    warnings.simplefilter('ignore')  # XML parsed as HTML, deprecated findChild
+
+    def soup(content):
+        return BeautifulSoup(content, 'html.parser')
+
+    def nodes(content, tag, key):
+        result = {}
+        legacy_node_recursively(soup(content).find(tag), result)
+        return result[key]
+
+    def profiles(content):
+        result = []
+        for p in soup(content).find_all('trt:profiles'):
+            result.append({p.findChild('tt:name').text: p.attrs['token']})
+        return result
+
+    def motion(content):
+        data = soup(content).find('tt:data')
+        return data.findChild().attrs['value']
+
+    return {
+        'get_capabilities': lambda c: nodes(c, 'tds:capabilities', 'capabilities'),
+        'get_device_information': lambda c: nodes(c, 'tds:getdeviceinformationresponse',
+                                                  'getdeviceinformationresponse'),
+        'get_system_date_and_time': lambda c: nodes(c, 'tds:systemdateandtime', 'systemdateandtime'),
+        'get_profiles': profiles,
+        'get_stream_uri': lambda c: soup(c).find('tt:uri').text,
+        'get_snapshot_uri': lambda c: soup(c).find('tt:uri').text,
+        'create_pull_point_subscription': lambda c: soup(c).find('tev:subscriptionreference')
+                                                           .findChild('wsa5:address').text,
+        'pull_messages': motion,
+    }
+
+
+def extractors():
+    def nodes(content, tag, key):
+        return pxml.to_dict(pxml.find(pxml.parse(content), tag))[key]
+
+    def profiles(content):
+        return [{pxml.find_text(p, pxml.NAME): p.get('token')} for p in pxml.parse(content).iter(pxml.PROFILES)]
+
+    def motion(content):
+        return pxml.first_child(pxml.find(pxml.parse(content), pxml.DATA)).get('Value')
+
+    return {
+        'get_capabilities': lambda c: nodes(c, pxml.CAPABILITIES, 'capabilities'),
+        'get_device_information': lambda c: nodes(c, pxml.DEVICE_INFORMATION, 'getdeviceinformationresponse'),
+        'get_system_date_and_time': lambda c: nodes(c, pxml.SYSTEM_DATE_TIME, 'systemdateandtime'),
+        'get_profiles': profiles,
+        'get_stream_uri': lambda c: pxml.find_text(pxml.parse(c), pxml.URI),
+        'get_snapshot_uri': lambda c: pxml.find_text(pxml.parse(c), pxml.URI),
+        'create_pull_point_subscription': lambda c: pxml.find_text(
+            pxml.find(pxml.parse(c), pxml.SUBSCRIPTION_REFERENCE), pxml.ADDRESS),
+        'pull_messages': motion,
+    }
+
+
+def measure(extract, content, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        extract(content)
+    return repeat / (time.perf_counter() - begin)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    after = extractors()
+    try:
+        before = legacy_extractors()
+    except ImportError:
+        before = None
+        print('before (BeautifulSoup): not installed')
+    print('{:<32}{:>14}{:>14}{:>10}'.format('response', 'before/s', 'after/s', 'speedup'))
+    for name, extract in after.items():
+        content = load(name)
+        new = extract(content)
+        if before is None:
+            print('{:<32}{:>14}{:>14,.0f}'.format(name, '-', measure(extract, content, repeat)))
+            continue
+        old = before[name](content)
+        assert old == new, '{}: {!r} != {!r}'.format(name, old, new)
+        slow = measure(before[name], content, max(repeat // 10, 1))
+        fast = measure(extract, content, repeat)
+        print('{:<32}{:>14,.0f}{:>14,.0f}{:>9.1f}x'.format(name, slow, fast, fast / slow))
+
+
+if __name__ == '__main__':
+    main()
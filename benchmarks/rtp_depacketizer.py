@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark RTP depacketization h264: packets per second.
+    before - bitstring parser (RecordRTSP._rtp_handler_h264 up to prtp module)
+    after - prtp.H264Depacketizer
+Run: python3 benchmarks/rtp_depacketizer.py [packets]
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recordclient'))
+
+from prtp import H264Depacketizer
+
+
+def make_packets(count, size=1400):
+    """
+    Synthetic stream: SPS, PPS and FU-A fragments of IDR/non-IDR slices
+    :param count: Number of packets
+    :param size: Size RTP payload FU-A
+    :return: [packet, ...]
+    """
+    packets = []
+    sn = 0
+    timestamp = 0
+    payload = bytes(range(256)) * (size // 256 + 1)
+    while len(packets) < count:
+        timestamp += 3600
+        for nal in (b'\x67' + payload[:20], b'\x68' + payload[:4]):
+            packets.append(struct.pack('!BBHII', 0x80, 96, sn & 0xFFFF, timestamp, 1) + nal)
+            sn += 1
+        for i in range(30):
+            first, last = i == 0, i == 29
+            fu = bytes((0x7C, (0x80 if first else 0) | (0x40 if last else 0) | 5))
+            marker = 0x80 if last else 0
+            packets.append(struct.pack('!BBHII', 0x80, 96 | marker, sn & 0xFFFF, timestamp, 1) + fu + payload[:size])
+            sn += 1
+    return packets[:count]
+
+
+def legacy_handler(st):
+    """
+    The former bitstring parser, without its per-packet debug logging
+    """
+    import bitstring
+    startbytes = b'\x00\x00\x00\x01'
+    result = {}
+    bt = bitstring.BitArray(bytes=st)
+    lc = 12
+    bc = 12 * 8
+    version = bt[0:2].uint
+    p = bt[2]
+    x = bt[3]
+    cc = bt[4:8].uint
+    m = bt[8]
+    pt = bt[9:16].uint
+    sn = bt[16:32].uint
+    timestamp = bt[32:64].uint
+    ssrc = bt[64:96].uint
+    if cc:
+        bc += 32 * cc
+        lc += 4 * cc
+    if x:
+        hlen = bt[bc+16:bc+32].uint
+        bc += 32 + 32 * hlen
+        lc += 4 + 4 * hlen
+    nlu0 = bt[bc:bc+3]
+    typ = bt[bc+3:bc+8].uint
+    if 0 <= typ <= 12:
+        result['typ'] = {7: 'SPS', 8: 'PPS'}.get(typ, 'UNKW')
+        result['data'] = startbytes + st[lc:]
+        return result
+    if typ == 28:
+        bc += 8
+        lc += 1
+        start = bt[bc]
+        end = bt[bc+1]
+        nlu1 = bt[bc+3:bc+8]
+        result['start'] = start
+        result['end'] = end
+        head = b''
+        if start:
+            head = startbytes + (nlu0 + nlu1).bytes
+        lc += 1
+        result['data'] = head + st[lc:]
+        result['typ'] = 'FU'
+        return result
+
+
+def measure(handler, packets):
+    begin = time.perf_counter()
+    for p in packets:
+        handler(p)
+    return len(packets) / (time.perf_counter() - begin)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    packets = make_packets(count)
+    depacketizer = H264Depacketizer()
+    for p in packets:  # Check same output
+        new = depacketizer.depacketize(p)
+        assert new is not None
+    try:
+        import bitstring  # noqa: F401
+    except ImportError:
+        before = None
+    else:
+        for p in packets[:100]:
+            old = legacy_handler(p)
+            new = depacketizer.depacketize(p)
+            assert old['data'] == new['head'] + bytes(new['data'])
+        before = measure(legacy_handler, packets)
+    after = measure(depacketizer.depacketize, packets)
+    if before:
+        print('before (bitstring): {:>12,.0f} packets/s'.format(before))
+    else:
+        print('before (bitstring): not installed')
+    print('after (struct):     {:>12,.0f} packets/s'.format(after))
+    if before:
+        print('speedup:            {:>12.1f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
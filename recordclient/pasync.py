@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import os
+import re
+import socket
+import time
+
+from prtp import AccessUnitAssembler, InterleavedDemuxer, JitterBuffer
+from prtsp import RTSP_TIMEOUT, RecordRTSP
+
+
+class RTPProtocol(asyncio.DatagramProtocol):
+    """
+    Receiving RTP packets of one camera in the event loop
+    """
+    def __init__(self, camera):
+        self.camera = camera
+
+    def datagram_received(self, data, addr):
+        self.camera.packet_received(data)
+
+    def error_received(self, exc):
+        logging.warning("{}: RTP socket error: {}".format(self.camera.name, exc))
+
+
+class AsyncRecordRTSP(RecordRTSP):
+    """
+    Online record of one camera in the event loop (see MultiRecorder).
+    RTSP control goes over asyncio streams with the messages of RecordRTSP,
+    RTP packets are received by RTPProtocol (or from the RTSP connection
+    for 'rtsp_transport' = tcp) and frames are passed to the writer
+    thread as they are assembled. UDP ports are chosen by the system,
+    so many cameras are recorded on one host.
+    """
+    def __init__(self, config, name=None):
+        """
+        :param config: Settings of RecordRTSP, 'rtp_timeout' - seconds without packets before reconnect
+        :param name: Name of the camera for logs and statistics
+        """
+        super().__init__(config)
+        self.name = name or self.ip_cam_adress
+        timeout = config.get('rtp_timeout')
+        self.rtp_timeout = float(timeout) if timeout else 5
+        self.packets = 0  # Received RTP packets
+        self.bytes = 0  # Received bytes of RTP packets
+        self._last_packet = 0
+        self._ctrl_reader = None
+        self._ctrl_writer = None
+        self._rtp = None
+        self._rtcp = None  # RTCP port of the pair is held, RTCP packets are ignored
+        self._interleaved = None  # Task of receiving interleaved RTP
+        self._opened = False  # The first file of the writer
+        self.msg_close = None
+
+    async def _request(self, message):
+        """
+        Send RTSP message and read the response with its body (SDP)
+        :param message: RTSP message
+        :return: Response from the camera
+        """
+        self._ctrl_writer.write(message)
+        head = await asyncio.wait_for(self._ctrl_reader.readuntil(b'\r\n\r\n'), RTSP_TIMEOUT)
+        length = re.search(rb'Content-Length:\s*(\d+)', head, re.IGNORECASE)
+        body = b''
+        if length:
+            body = await asyncio.wait_for(self._ctrl_reader.readexactly(int(length.group(1))), RTSP_TIMEOUT)
+        response = (head + body).decode(errors='replace')
+        self._log_record(response)
+        return response
+
+    async def start(self):
+        """
+        Start control RTSP stream and receiving of RTP packets
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        self._ctrl_reader, self._ctrl_writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip_cam_adress, self.ip_cam_port), RTSP_TIMEOUT)
+        if self.sdp is None:
+            resp = await self._request(self.msg_describe)
+            self._set_depacketizer(self._get_codec(resp))
+            self.sdp = resp
+        self.jitter_buffer = JitterBuffer(self.jitter_size, self.jitter_latency)
+        self.assembler = AccessUnitAssembler(self.depacketizer)
+        if self.rtsp_transport == 'tcp':
+            resp = await self._request(self._make_setup_msg(None))
+        else:
+            sock, rtcp = self._make_rtp_sockets()
+            port = sock.getsockname()[1]
+            self._rtp, _ = await loop.create_datagram_endpoint(lambda: RTPProtocol(self), sock=sock)
+            self._rtcp, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, sock=rtcp)
+            resp = await self._request(self._make_setup_msg([port, port + 1]))
+        if self._status(resp) != 200:
+            self.sdp = None  # Stream is changed, DESCRIBE on the next connect
+            raise ConnectionError("SETUP failed: {}".format(resp.split('\r\n', 1)[0]))
+        if not self._opened:  # Extension and muxer of the codec are known after DESCRIBE
+            self.writer.open(self._filename(), self._segment_names())
+            self._opened = True
+        id_session = self._id_session(resp)
+        self.id_session = id_session
+        self.msg_close = self._make_send_msg(id_session, self.m_close)
+        self.keepalive_interval = max(self._session_timeout(resp) / 2, 1)
+        self._keepalive_at = time.monotonic() + self.keepalive_interval
+        self._last_packet = time.monotonic()
+        await self._request(self._make_send_msg(id_session, self.m_play))
+        if self.rtsp_transport == 'tcp':
+            channel = self._get_ports("interleaved", resp)[0] if 'interleaved=' in resp else 0
+            self._interleaved = loop.create_task(self._receive_interleaved(channel))
+
+    def _make_rtp_sockets(self, attempts=16):
+        """
+        UDP sockets of a free even/odd port pair of the system (RFC 3550 11),
+        so the RTCP port is not the RTP port of another camera
+        :param attempts: Ports tried
+        :return: (RTP socket, RTCP socket)
+        """
+        for _ in range(attempts):
+            sock = self._make_udp_socket([0])
+            port = sock.getsockname()[1]
+            if port and port % 2 == 0:
+                rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    rtcp.bind(('', port + 1))
+                    return sock, rtcp
+                except OSError:
+                    rtcp.close()
+            sock.close()
+        raise OSError("No free pair of RTP/RTCP ports")
+
+    async def _receive_interleaved(self, channel):
+        """
+        Read RTP packets interleaved in the RTSP connection
+        :param channel: Interleaved channel of RTP packets
+        :return: None
+        """
+        demuxer = InterleavedDemuxer(channel)
+        while True:
+            data = await self._ctrl_reader.read(65536)
+            if not data:
+                logging.error("{}: RTSP connection closed".format(self.name))
+                return
+            for packet in demuxer.feed(data):
+                self.packet_received(packet)
+
+    def packet_received(self, packet):
+        """
+        Assemble frames from RTP packet and queue them for writing
+        :param packet: RTP packet
+        :return: None
+        """
+        self.packets += 1
+        self.bytes += len(packet)
+        self._last_packet = time.monotonic()
+        for frame in self.assembler.feed(self.jitter_buffer.push(packet)):
+            if self._gap_begin is not None:
+                self._end_gap(frame.time)
+            self.last_frame = frame.time
+            self.writer.write(frame)
+
+    async def _send_keepalive(self):
+        """
+        Keepalive of the session, the response is read here for UDP transport
+        and is skipped by the demultiplexer for interleaved transport
+        :return: None
+        """
+        self._keepalive_at = time.monotonic() + self.keepalive_interval
+        message = self._make_keepalive_msg()
+        self.keepalives += 1
+        if self._interleaved is not None:
+            self._ctrl_writer.write(message)
+            return
+        resp = await self._request(message)
+        if self._status(resp) != 200:
+            logging.warning("{}: keepalive response: {}".format(self.name, resp.split('\r\n', 1)[0]))
+
+    async def finish(self):
+        """
+        Close connection
+        :return: None
+        """
+        if self._interleaved is not None:
+            self._interleaved.cancel()
+            self._interleaved = None
+        if self._rtp is not None:
+            self._rtp.close()
+            self._rtp = None
+        if self._rtcp is not None:
+            self._rtcp.close()
+            self._rtcp = None
+        if self.msg_close:  # Session is set up
+            logging.info("{}: RTP stream: {}".format(self.name, self._stream_stats()))
+        if self._ctrl_writer is not None:
+            try:
+                if self.msg_close:
+                    self._ctrl_writer.write(self.msg_close)
+                    await asyncio.wait_for(self._ctrl_writer.drain(), RTSP_TIMEOUT)
+                self._ctrl_writer.close()
+            except OSError:
+                pass
+            self._ctrl_writer = None
+            self.msg_close = None
+
+    async def _watch(self, stop):
+        """
+        Wait for stop, check that packets are received, send keepalive
+        :param stop: asyncio.Event
+        :return: None
+        """
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                if now - self._last_packet > self.rtp_timeout:
+                    raise asyncio.TimeoutError("no RTP packets for {} s".format(self.rtp_timeout))
+                if now >= self._keepalive_at:
+                    await self._send_keepalive()
+
+    async def run(self, stop):
+        """
+        Record until 'stop' is set, reconnect on errors at once after a working session,
+        then with exponential backoff from 'reconnect_delay' up to 'reconnect_max_delay' seconds.
+        Files are rotated by 'segment_size' and 'segment_duration'.
+        :param stop: asyncio.Event
+        :return: None
+        """
+        writer = self._get_writer()  # The file is opened by the first start()
+        delay = 0
+        try:
+            while not stop.is_set():
+                packets = self.packets
+                try:
+                    await self.start()
+                    await self._watch(stop)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as error:
+                    logging.error("{}: {}".format(self.name, error or type(error).__name__))
+                    self._begin_gap()
+                finally:
+                    await self.finish()
+                if stop.is_set():
+                    break
+                if self.packets > packets:
+                    delay = 0
+                else:
+                    delay = min(delay * 2 or self.reconnect_delay, self.reconnect_max_delay)
+                    try:
+                        await asyncio.wait_for(stop.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            writer.close()
+            await asyncio.get_running_loop().run_in_executor(None, self._stop_writer)
+
+    def stats(self):
+        return {'packets': self.packets, 'bytes': self.bytes, 'reconnects': self.reconnects,
+                'gap_ms': round(self.gap_ms)}
+
+
+class MultiRecorder:
+    """
+    Online record of many cameras in one event loop of one process.
+    Every camera is recorded to its own directory 'dir_record/name'.
+    """
+    def __init__(self, cameras=None):
+        """
+        :param cameras: {name: settings of RecordRTSP with 'rtsp_url'}
+        """
+        self.cameras = {}  # name: AsyncRecordRTSP
+        self._stops = {}  # name: asyncio.Event
+        self._tasks = set()  # asyncio.Task named by camera
+        self._running = False
+        self._stopped = False
+        for name, config in (cameras or {}).items():
+            self.add(name, config)
+
+    def add(self, name, config):
+        """
+        Add camera, it is recorded at once if the recorder is running
+        :param name: Name of the camera
+        :param config: Settings of RecordRTSP
+        :return: None
+        """
+        if name in self.cameras:
+            self.remove(name)
+        config = dict(config)
+        path = os.path.join(os.path.abspath(config.get('dir_record') or os.getcwd()), name)
+        os.makedirs(path, exist_ok=True)
+        config['dir_record'] = path
+        self.cameras[name] = AsyncRecordRTSP(config, name)
+        if self._running:
+            self._start_camera(name)
+
+    def remove(self, name):
+        """
+        Stop record of camera
+        :param name: Name of the camera
+        :return: None
+        """
+        self.cameras.pop(name, None)
+        stop = self._stops.pop(name, None)
+        if stop is not None:
+            stop.set()
+
+    def _start_camera(self, name):
+        stop = asyncio.Event()
+        self._stops[name] = stop
+        self._tasks.add(asyncio.get_running_loop().create_task(self.cameras[name].run(stop), name=name))
+
+    def stats(self):
+        """
+        :return: {name: {'packets', 'bytes', 'reconnects', 'gap_ms'}}
+        """
+        return {name: camera.stats() for name, camera in self.cameras.items()}
+
+    def stop(self):
+        """
+        Stop record of all cameras, run() returns
+        :return: None
+        """
+        self._stopped = True
+
+    async def run(self, stop=None):
+        """
+        Record cameras until 'stop' is set
+        :param stop: multiprocessing.Event() or None - record until cancelled
+        :return: None
+        """
+        self._running = True
+        for name in self.cameras:
+            self._start_camera(name)
+        try:
+            while not self._stopped and (stop is None or not stop.is_set()):
+                await asyncio.sleep(0.5)
+                for task in [t for t in self._tasks if t.done()]:
+                    self._tasks.discard(task)
+                    if not task.cancelled() and task.exception():
+                        logging.error("{}: record failed: {}".format(task.get_name(), task.exception()))
+        finally:
+            self._running = False
+            for event in self._stops.values():
+                event.set()
+            self._stops.clear()
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks.clear()
+
+
+def record_cameras(cameras, stop=None):
+    """
+    Online record of cameras in this process
+    :param cameras: {name: settings of RecordRTSP with 'rtsp_url'}
+    :param stop: multiprocessing.Event() - stop record
+    :return: None
+    """
+    try:
+        asyncio.run(MultiRecorder(cameras).run(stop))
+    except KeyboardInterrupt:
+        pass
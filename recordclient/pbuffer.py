@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import itertools
+import logging
+import mmap
+import os
+
+from collections import deque
+
+from prtp import Frame
+
+
+class PreBuffer:
+    """
+    Pre-record ring buffer of frames bounded in bytes and in seconds of RTP time.
+    Frames are copied into one preallocated contiguous buffer, every frame
+    is kept contiguous and is found by the frame index.
+    """
+    def __init__(self, max_bytes, max_seconds, clock_rate=90000):
+        """
+        :param max_bytes: Size of the buffer in bytes
+        :param max_seconds: Maximum duration of the buffered frames
+        :param clock_rate: RTP clock rate of the stream
+        """
+        self.max_bytes = max_bytes
+        self.max_duration = int(max_seconds * clock_rate)
+        self._allocate()
+        self._frames = deque()  # (offset, size, timestamp, keyframe, time)
+        self._head = 0  # Offset for the next frame
+        self.dropped = 0  # Frames larger than the buffer
+
+    def _allocate(self):
+        self._data = bytearray(self.max_bytes)
+        self._view = memoryview(self._data)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def duration(self):
+        """
+        :return: Duration of the buffered frames in RTP clock units
+        """
+        if not self._frames:
+            return 0
+        return (self._frames[-1][2] - self._frames[0][2]) & 0xFFFFFFFF
+
+    def _reserve(self, size):
+        """
+        Free contiguous space removing the oldest frames
+        :param size: Size of frame
+        :return: Offset for frame
+        """
+        frames = self._frames
+        while frames:
+            tail = frames[0][0]
+            if self._head > tail:
+                if self.max_bytes - self._head >= size:
+                    return self._head
+                if tail >= size:  # Wrap around, the end of the buffer stays unused
+                    return 0
+            elif tail - self._head >= size:
+                return self._head
+            frames.popleft()
+        return 0
+
+    def append(self, frame):
+        """
+        Copy frame into the buffer
+        :param frame: prtp.Frame
+        :return: None
+        """
+        size = len(frame.data)
+        if size > self.max_bytes:
+            self.dropped += 1
+            self.clear()
+            logging.warning("Frame is larger than pre-record buffer: {} bytes".format(size))
+            return
+        offset = self._reserve(size)
+        self._view[offset:offset + size] = frame.data
+        self._head = offset + size
+        self._frames.append((offset, size, frame.timestamp, frame.keyframe, frame.time))
+        frames = self._frames
+        while len(frames) > 1 and (frame.timestamp - frames[0][2]) & 0xFFFFFFFF > self.max_duration:
+            frames.popleft()
+
+    def clear(self):
+        self._frames.clear()
+        self._head = 0
+
+    def _skip_to_keyframe(self):
+        frames = self._frames
+        while frames and not frames[0][3]:
+            frames.popleft()
+
+    def flush_to(self, writer):
+        """
+        Write the buffered frames to the current file of writer and clear the buffer
+        :param writer: pwriter.FrameWriter
+        :return: None
+        """
+        writer.write_frames(self.drain())
+
+    def close(self):
+        pass
+
+    def drain(self):
+        """
+        Take the buffered frames from the oldest key frame and clear the buffer.
+        The one or two contiguous ranges of the ring (before and after the wrap around)
+        are copied out at once, so the buffer is free for the next frames,
+        data of frames are memoryview slices of the copies.
+        :return: [prtp.Frame, ...]
+        """
+        self._skip_to_keyframe()
+        result = []
+        frames = self._frames
+        while frames:
+            begin = frames[0][0]
+            count = 1
+            while count < len(frames) and frames[count][0] >= frames[count - 1][0]:
+                count += 1
+            last = frames[count - 1]
+            copy = memoryview(bytes(self._view[begin:last[0] + last[1]]))
+            for _ in range(count):
+                offset, size, timestamp, keyframe, time = frames.popleft()
+                result.append(Frame(copy[offset - begin:offset - begin + size], timestamp, keyframe, time))
+        self.clear()
+        return result
+
+
+class MappedPreBuffer(PreBuffer):
+    """
+    Pre-record ring buffer in a memory-mapped file, for long pre-record
+    without keeping it in RAM (pages of the file are cached by the system).
+    On start of record the file is detached by rename and written to the record
+    by the writer thread, the buffer continues in a new file.
+    """
+    _detached = itertools.count()
+
+    def __init__(self, max_bytes, max_seconds, path, clock_rate=90000):
+        """
+        :param max_bytes: Size of the buffer file in bytes
+        :param max_seconds: Maximum duration of the buffered frames
+        :param path: Buffer file
+        :param clock_rate: RTP clock rate of the stream
+        """
+        self.path = path
+        self._map = None
+        super().__init__(max_bytes, max_seconds, clock_rate)
+
+    def _allocate(self):
+        with open(self.path, 'w+b') as spool:
+            spool.truncate(self.max_bytes)  # Sparse file
+            self._map = mmap.mmap(spool.fileno(), self.max_bytes)
+        self._data = self._map
+        self._view = memoryview(self._map)
+
+    def close(self):
+        """
+        Unmap and remove the buffer file
+        :return: None
+        """
+        if self._map is None:
+            return
+        self._view.release()
+        self._map.close()
+        self._map = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def detach(self):
+        """
+        Detach the buffer file with the buffered frames from the oldest key frame,
+        the buffer is cleared and continues in a new file.
+        :return: (detached file, [(offset, size, timestamp, keyframe, time), ...])
+        """
+        self._skip_to_keyframe()
+        frames = list(self._frames)
+        self.clear()
+        self._view.release()
+        self._map.close()
+        detached = '{}.{}'.format(self.path, next(self._detached))
+        os.replace(self.path, detached)
+        self._allocate()
+        return detached, frames
+
+    def flush_to(self, writer):
+        """
+        Write the buffered frames to the current file of writer without copying
+        them in this process, see pwriter.FrameWriter.write_spool
+        :param writer: pwriter.FrameWriter
+        :return: None
+        """
+        writer.write_spool(*self.detach())
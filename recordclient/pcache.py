@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_lock = threading.Lock()  # Caches of all cameras of the process
+
+
+class MetadataCache:
+    """
+    Cache of camera metadata in a JSON file: {key: {'time': saving time, ...}}.
+    The file is replaced atomically, changes are serialized between threads
+    and between processes (lock of the file <path>.lock), so cameras may share it.
+    """
+    def __init__(self, path, ttl=86400):
+        """
+        :param path: Cache file
+        :param ttl: Seconds an entry is used without checking the device
+        """
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            logging.warning("Fail read cache {}: {}".format(self.path, error))
+            return {}
+
+    def _write(self, entries):
+        try:
+            fd, temp = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+                                        dir=os.path.dirname(self.path))
+        except OSError as error:
+            logging.warning("Fail write cache {}: {}".format(self.path, error))
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(temp, self.path)
+        except OSError as error:
+            logging.warning("Fail write cache {}: {}".format(self.path, error))
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    @contextmanager
+    def _locked(self):
+        """
+        Exclusive change of the file by threads and processes
+        """
+        with _lock:
+            if fcntl is None:
+                yield
+                return
+            try:
+                f = open(self.path + '.lock', 'a')
+            except OSError as error:
+                logging.warning("Fail lock cache {}: {}".format(self.path, error))
+                yield
+                return
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """
+        :param key: Key of device
+        :return: Entry or None
+        """
+        return self._read().get(key)
+
+    def is_fresh(self, entry):
+        """
+        :param entry: Entry of get()
+        :return: True if the entry is younger than ttl
+        """
+        return time.time() - entry.get('time', 0) < self.ttl
+
+    def put(self, key, entry):
+        """
+        Save entry, its time is the current time
+        :param key: Key of device
+        :param entry: dict serializable to JSON
+        :return: None
+        """
+        with self._locked():
+            entries = self._read()
+            entries[key] = dict(entry, time=time.time())
+            self._write(entries)
+
+    def update(self, key, fields):
+        """
+        Change fields of an existing entry, its time is kept, so the entry is checked after ttl as before
+        :param key: Key of device
+        :param fields: dict serializable to JSON
+        :return: None
+        """
+        with self._locked():
+            entries = self._read()
+            if key in entries:
+                entries[key].update(fields)
+                self._write(entries)
+
+    def invalidate(self, key):
+        """
+        Remove entry, i.e. when a request with the cached data fails
+        :param key: Key of device
+        :return: None
+        """
+        with self._locked():
+            entries = self._read()
+            if entries.pop(key, None) is not None:
+                self._write(entries)
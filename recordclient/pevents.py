@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import calendar
+import re
+
+import pxml
+
+
+TIME_PATTERN = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+MOTION_ITEMS = ('IsMotion', 'State')  # CellMotionDetector/Motion, VideoSource/MotionAlarm
+
+
+def parse_time(value):
+    """
+    :param value: xs:dateTime of ONVIF, i.e. 2016-09-14T09:41:28.5Z
+    :return: Seconds since the epoch or None
+    """
+    match = TIME_PATTERN.match((value or '').strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second = (int(i) for i in match.groups()[:6])
+    seconds = calendar.timegm((year, month, day, hour, minute, second))
+    if match.group(7):
+        seconds += float(match.group(7))
+    zone = match.group(8)
+    if zone and zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        seconds -= offset if zone[0] == '+' else -offset
+    return seconds
+
+
+def _simple_items(element):
+    if element is None:
+        return {}
+    return {i.get('Name'): i.get('Value') for i in element.iter(pxml.SIMPLE_ITEM)}
+
+
+class OnvifEvent:
+    """
+    One NotificationMessage of PullMessages
+    """
+    def __init__(self, topic, time, operation, source, data, received, current_time=None):
+        """
+        :param topic: Topic, i.e. tns1:RuleEngine/CellMotionDetector/Motion
+        :param time: UtcTime of the event on the camera, seconds since the epoch or None
+        :param operation: PropertyOperation: Initialized, Changed, Deleted or None
+        :param source: {name: value} of the source items
+        :param data: {name: value} of the data items
+        :param received: Local time of the response
+        :param current_time: CurrentTime of the camera in the response
+        """
+        self.topic = topic
+        self.time = time
+        self.operation = operation
+        self.source = source
+        self.data = data
+        self.received = received
+        self.current_time = current_time
+
+    @property
+    def motion(self):
+        """
+        :return: State of motion of motion topics, None for other events
+        """
+        if 'Motion' not in self.topic:
+            return None
+        for name in MOTION_ITEMS:
+            if name in self.data:
+                return self.data[name].lower() == 'true'
+        return None
+
+    @property
+    def latency(self):
+        """
+        Seconds from the event on the camera to the local receipt,
+        the clock of the camera is expected to be synchronized
+        :return: float or None
+        """
+        return None if self.time is None else self.received - self.time
+
+    @property
+    def delay(self):
+        """
+        Seconds from the event to the response by the clock of the camera,
+        i.e. the latency without the clock difference and the network
+        :return: float or None
+        """
+        if self.time is None or self.current_time is None:
+            return None
+        return self.current_time - self.time
+
+    def __repr__(self):
+        return 'OnvifEvent({}, {}, {}, {})'.format(self.topic, self.time, self.source, self.data)
+
+
+def parse_events(root, received):
+    """
+    All notification messages of PullMessagesResponse
+    :param root: Element of the response
+    :param received: Local time of the response
+    :return: [OnvifEvent, ...] in the order of the response
+    """
+    current_time = parse_time(pxml.find_text(root, pxml.CURRENT_TIME))
+    result = []
+    for notification in root.iter(pxml.NOTIFICATION_MESSAGE):
+        message = pxml.find(notification, pxml.MESSAGE)
+        if message is None:
+            continue
+        topic = (pxml.find_text(notification, pxml.TOPIC) or '').strip()
+        result.append(OnvifEvent(topic,
+                                 parse_time(message.get('UtcTime')),
+                                 message.get('PropertyOperation'),
+                                 _simple_items(pxml.find(message, pxml.SOURCE)),
+                                 _simple_items(pxml.find(message, pxml.DATA)),
+                                 received,
+                                 current_time))
+    return result
+
+
+class LatencyStats:
+    """
+    Statistics of event latency in seconds
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.last = None
+
+    def add(self, latency):
+        """
+        :param latency: Seconds or None (unknown time of the event)
+        :return: None
+        """
+        if latency is None:
+            return
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        self.max = latency if self.max is None else max(self.max, latency)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        if not self.count:
+            return 'no events'
+        return 'events: {}, mean: {:.3f} s, max: {:.3f} s, last: {:.3f} s'.format(self.count, self.mean(),
+                                                                                  self.max, self.last)
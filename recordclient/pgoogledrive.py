@@ -1,5 +1,6 @@
 import httplib2
 import json
+import logging
 import mimetypes
 import oauth2client
 import os
@@ -11,6 +12,10 @@ from apiclient.http import MediaFileUpload
 from oauth2client import client
 from oauth2client import tools
 
+import pcache
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
 
 class GoogleDrive:
 
@@ -26,6 +31,9 @@ class GoogleDrive:
         self.folder_id = config.get('folder_id')
         self.service = self._google_drive_service()
         self.current_folder = datetime.now().strftime('%Y%m%d')
+        self.folders = {}  # {name: ID} of date folders in folder_id, only the current date
+        cache_file = config.get('folder_cache')  # JSON file of folder IDs, empty - in memory only
+        self.folder_cache = pcache.MetadataCache(cache_file) if cache_file else None
 
     def _google_drive_service(self):
         """
@@ -69,8 +77,10 @@ class GoogleDrive:
           }
         try:
             self.service.files().create(body=body, media_body=media_body).execute()
-        except errors.HttpError:
-            print('An error occured: ')
+        except errors.HttpError as error:
+            logging.error("Fail upload {}: {}".format(upload_file, error))
+            return False
+        return True
 
     def get_all_folders(self, trashed=False):
         result = {}
@@ -100,27 +110,63 @@ class GoogleDrive:
                                            fields='id, name').execute()
         return file
 
+    def find_folder(self, name, parent=None):
+        """
+        Folder by name in the parent, one request instead of the list of all folders
+        :param name: Folder name
+        :param parent: ID of the parent folder, folder_id by default, the root folder without folder_id
+        :return: ID folder or None
+        """
+        if parent is None:
+            parent = self.folder_id or 'root'
+        q = "name = '{n}' and '{p}' in parents and mimeType = '{m}' and trashed = false".format(
+            n=name.replace('\\', '\\\\').replace("'", "\\'"), p=parent, m=FOLDER_MIME_TYPE)
+        response = self.service.files().list(q=q,
+                                             spaces='drive',
+                                             fields='files(id, name)',
+                                             pageSize=1).execute()
+        files = response.get('files', [])
+        return files[0].get('id') if files else None
+
+    def _folder_key(self, name):
+        return '{}/{}'.format(self.folder_id, name)
+
+    def _forget_folder(self, name):
+        self.folders.pop(name, None)
+        if self.folder_cache is not None:
+            self.folder_cache.invalidate(self._folder_key(name))
+
     def get_current_folder(self):
         """
-        Check current folder for upload
+        Folder of the current date for upload, it is found or created once a day,
+        then it is taken from the cache
         :return: ID folder
         """
         date = datetime.now().strftime('%Y%m%d')
-        if date != self.current_folder:
-            self.current_folder = date
-        folders = self.get_all_folders()
-        if self.current_folder in list(folders.keys()):
-            result = folders[self.current_folder]
-        else:
+        if date != self.current_folder:  # Midnight
+            self._forget_folder(self.current_folder)
             self.current_folder = date
-            folder = self.create_folder(self.current_folder)
-            result = folder['id']
+        result = self.folders.get(date)
+        if result:
+            return result
+        if self.folder_cache is not None:
+            entry = self.folder_cache.get(self._folder_key(date))
+            result = entry.get('id') if entry else None
+        if not result:
+            result = self.find_folder(date)
+        if not result:
+            result = self.create_folder(date)['id']
+        self.folders[date] = result
+        if self.folder_cache is not None:
+            self.folder_cache.put(self._folder_key(date), {'id': result})
         return result
 
     def upload(self, file):
         try:
             folder = self.get_current_folder()
-            self.upload_file(file, folder)
-            return True
+            if self.upload_file(file, folder):
+                return True
+            self._forget_folder(self.current_folder)  # i.e. the folder was removed, it is found again
+            return self.upload_file(file, self.get_current_folder())
         except:
             return False
\ No newline at end of file
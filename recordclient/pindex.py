@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import bisect
+import struct
+
+
+INDEX_HEADER = struct.Struct('>4sB3x')  # Magic, version
+INDEX_ENTRY = struct.Struct('>QId')  # Byte offset, RTP timestamp, wall-clock time
+INDEX_MAGIC = b'RIDX'
+INDEX_VERSION = 1
+
+
+def index_path(filename):
+    """
+    Sidecar index of record file
+    :param filename: Record file name
+    :return: File name of the index: 20160101-121134-0.h264.idx
+    """
+    return filename + '.idx'
+
+
+class KeyframeIndex:
+    """
+    Reader of the key frame index written by pwriter.FrameWriter.
+    Every entry is the byte offset in the record file, RTP timestamp
+    and wall-clock time of a key frame (SPS/IDR), entries are ordered by time.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: Record file name or its index file name
+        """
+        path = filename if filename.endswith('.idx') else index_path(filename)
+        with open(path, 'rb') as index:
+            data = index.read()
+        magic, version = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Not a key frame index: {}".format(path))
+        size = (len(data) - INDEX_HEADER.size) // INDEX_ENTRY.size * INDEX_ENTRY.size  # Last entry may be incomplete
+        entries = list(INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:INDEX_HEADER.size + size]))
+        self.offsets = [e[0] for e in entries]
+        self.timestamps = [e[1] for e in entries]
+        self.times = [e[2] for e in entries]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def find(self, when):
+        """
+        Last key frame at or before the time
+        :param when: Wall-clock time (time.time())
+        :return: Number of entry, 0 if the time is before the first key frame
+        """
+        return max(bisect.bisect_right(self.times, when) - 1, 0)
+
+    def offset(self, when):
+        """
+        Byte offset to start playing from the time
+        :param when: Wall-clock time (time.time())
+        :return: Offset or None for empty index
+        """
+        if not self.offsets:
+            return None
+        return self.offsets[self.find(when)]
+
+    def byte_range(self, begin, end):
+        """
+        Bytes of the record for clip from 'begin' to 'end'.
+        For MP4 file the init segment (bytes up to the first entry) goes before the clip.
+        :param begin: Wall-clock time of the clip beginning
+        :param end: Wall-clock time of the clip end
+        :return: (first byte, end byte or None up to the end of file)
+        """
+        if not self.offsets:
+            return 0, None
+        first = self.find(begin)
+        last = bisect.bisect_right(self.times, end)
+        if last >= len(self.offsets):
+            return self.offsets[first], None
+        return self.offsets[first], self.offsets[last]
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+import struct
+
+from prtp import START_CODE
+
+
+TIMESCALE = 90000  # RTP clock rate of video
+SAMPLE_SYNC = 0x02000000  # sample_depends_on = 2
+SAMPLE_NON_SYNC = 0x01010000  # sample_depends_on = 1, sample_is_non_sync_sample = 1
+START_CODE_PATTERN = re.compile(re.escape(START_CODE))  # Searches memoryview too (see pbuffer.PreBuffer.drain)
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def split_nal_units(data):
+    """
+    Split Annex B buffer with 4-byte start codes (see prtp.AccessUnitAssembler)
+    :param data: NAL units with start codes, bytes-like object
+    :return: [memoryview of NAL unit, ...]
+    """
+    view = memoryview(data)
+    units = []
+    match = START_CODE_PATTERN.search(data)
+    while match:
+        begin = match.end()
+        match = START_CODE_PATTERN.search(data, begin)
+        units.append(view[begin:match.start() if match else len(view)])
+    return units
+
+
+def box(kind, *payload):
+    """
+    ISO BMFF box
+    :param kind: Box type, i.e. b'moov'
+    :param payload: Content of the box
+    :return: bytes
+    """
+    data = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+
+def full_box(kind, version, flags, *payload):
+    return box(kind, struct.pack('>I', (version << 24) | flags), *payload)
+
+
+class BitReader:
+    """
+    Reading of RBSP (emulation prevention bytes are removed) for parsing parameter sets
+    """
+    def __init__(self, data):
+        self.data = bytes(data).replace(b'\x00\x00\x03', b'\x00\x00')
+        self.pos = 0
+
+    def u(self, bits):
+        value = 0
+        for _ in range(bits):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def h264_sps_size(sps):
+    """
+    Picture size from H264 SPS
+    :param sps: SPS NAL unit without start code
+    :return: (width, height)
+    """
+    r = BitReader(sps)
+    r.u(8)  # NAL header
+    profile = r.u(8)
+    r.u(16)  # Constraint flags, level
+    r.ue()  # seq_parameter_set_id
+    chroma_format = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = r.ue()
+        if chroma_format == 3:
+            r.u(1)  # separate_colour_plane_flag
+        r.ue()  # bit_depth_luma_minus8
+        r.ue()  # bit_depth_chroma_minus8
+        r.u(1)  # qpprime_y_zero_transform_bypass_flag
+        if r.u(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format != 3 else 12):
+                if r.u(1):
+                    last = scale = 8
+                    for j in range(16 if i < 6 else 64):
+                        if scale:
+                            scale = (last + r.se()) % 256
+                        last = scale or last
+    r.ue()  # log2_max_frame_num_minus4
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif poc_type == 1:
+        r.u(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()  # max_num_ref_frames
+    r.u(1)  # gaps_in_frame_num_value_allowed_flag
+    width = (r.ue() + 1) * 16  # pic_width_in_mbs_minus1
+    height = (r.ue() + 1) * 16  # pic_height_in_map_units_minus1
+    frame_mbs_only = r.u(1)
+    height *= 2 - frame_mbs_only
+    if not frame_mbs_only:
+        r.u(1)  # mb_adaptive_frame_field_flag
+    r.u(1)  # direct_8x8_inference_flag
+    if r.u(1):  # frame_cropping_flag
+        crop_x = 2 if chroma_format in (1, 2) else 1
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    return width, height
+
+
+def h265_sps_info(sps):
+    """
+    Profile and picture size from H265 SPS
+    :param sps: SPS NAL unit without start code
+    :return: {'width', 'height', 'profile_tier_level': 12 bytes, 'sub_layers', 'temporal_id_nesting',
+              'chroma_format', 'bit_depth_luma', 'bit_depth_chroma'}
+    """
+    r = BitReader(sps)
+    r.u(16)  # NAL header
+    r.u(4)  # sps_video_parameter_set_id
+    max_sub_layers = r.u(3)  # sps_max_sub_layers_minus1
+    nesting = r.u(1)
+    ptl = bytes(r.u(8) for _ in range(12))  # General profile, tier and level
+    present = [(r.u(1), r.u(1)) for _ in range(max_sub_layers)]
+    if max_sub_layers:
+        r.u(2 * (8 - max_sub_layers))
+    for profile_present, level_present in present:
+        if profile_present:
+            r.u(88)
+        if level_present:
+            r.u(8)
+    r.ue()  # sps_seq_parameter_set_id
+    chroma_format = r.ue()
+    if chroma_format == 3:
+        r.u(1)  # separate_colour_plane_flag
+    width = r.ue()
+    height = r.ue()
+    if r.u(1):  # conformance_window_flag
+        sub_width = 2 if chroma_format in (1, 2) else 1
+        sub_height = 2 if chroma_format == 1 else 1
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        width -= sub_width * (left + right)
+        height -= sub_height * (top + bottom)
+    bit_depth_luma = r.ue() + 8
+    bit_depth_chroma = r.ue() + 8
+    return {'width': width, 'height': height, 'profile_tier_level': ptl, 'sub_layers': max_sub_layers + 1,
+            'temporal_id_nesting': nesting, 'chroma_format': chroma_format,
+            'bit_depth_luma': bit_depth_luma, 'bit_depth_chroma': bit_depth_chroma}
+
+
+class AnnexB:
+    """
+    Elementary stream (.h264, .h265): frames are written as is
+    """
+    extension = None  # Extension of the codec, i.e. 'h264'
+    buffered = False  # Frame is returned by add() of the frame itself
+
+    def __init__(self, codec='H264'):
+        self.codec = codec
+
+    def add(self, frame):
+        """
+        :param frame: prtp.Frame
+        :return: [buffer, ...] for writing
+        """
+        return [frame.data]
+
+    def finish(self):
+        """
+        :return: [buffer, ...] for writing at the end of file
+        """
+        return []
+
+
+class FragmentedMP4:
+    """
+    Streaming fragmented MP4 (ISO BMFF) muxer of H264/H265 frames.
+    Init segment (ftyp, moov) is built from the parameter sets of the first key frame,
+    then every fragment (moof, mdat) is written as soon as it is complete, so the file
+    is seekable and playable while it is recorded. Memory is bounded by one fragment.
+    Decode time is taken from RTP timestamps, B-frames are not supported.
+    """
+    extension = 'mp4'
+    buffered = True  # Key frame begins the fragment written after output of add()
+
+    def __init__(self, codec='H264', fragment_duration=1.0):
+        """
+        :param codec: 'H264' or 'H265'
+        :param fragment_duration: Maximum duration of fragment in seconds, fragments also begin at key frames
+        """
+        self.codec = codec
+        self.hevc = codec in ('H265', 'HEVC')
+        self.fragment_duration = int(fragment_duration * TIMESCALE)
+        self._sequence = 0
+        self._samples = []  # (units, keyframe, decode time)
+        self._started = False
+        self._last_timestamp = None
+        self._decode_time = 0
+        self._duration = 3600  # Duration of the last sample, 25 fps before the second frame
+
+    def _nal_type(self, unit):
+        if self.hevc:
+            return (unit[0] >> 1) & 0x3F
+        return unit[0] & 0x1F
+
+    def _parameter_sets(self, units):
+        sets = {}
+        names = {32: 'VPS', 33: 'SPS', 34: 'PPS'} if self.hevc else {7: 'SPS', 8: 'PPS'}
+        for unit in units:
+            name = names.get(self._nal_type(unit))
+            if name and name not in sets:
+                sets[name] = bytes(unit)
+        return sets
+
+    def add(self, frame):
+        """
+        :param frame: prtp.Frame
+        :return: [buffer, ...] for writing
+        """
+        units = split_nal_units(frame.data)
+        out = []
+        if not self._started:
+            if not frame.keyframe:
+                return out  # Wait the key frame with parameter sets
+            try:
+                out.append(self.init_segment(self._parameter_sets(units)))
+            except (KeyError, IndexError) as error:
+                logging.error("fMP4: no parameter sets in the key frame ({})".format(error))
+                return out
+            self._started = True
+        else:
+            delta = (frame.timestamp - self._last_timestamp) & 0xFFFFFFFF
+            if delta >= 0x80000000:  # Timestamp is going back
+                delta = 1
+            self._duration = delta or 1
+            self._decode_time += self._duration
+            if self._samples:
+                fragment_time = self._decode_time - self._samples[0][2]
+                if frame.keyframe or fragment_time >= self.fragment_duration:
+                    out.extend(self._fragment())
+        self._last_timestamp = frame.timestamp
+        self._samples.append((units, frame.keyframe, self._decode_time))
+        return out
+
+    def finish(self):
+        """
+        :return: [buffer, ...] of the last fragment
+        """
+        if not self._samples:
+            return []
+        return self._fragment(last=True)
+
+    def _fragment(self, last=False):
+        """
+        Build moof and mdat of the buffered samples
+        :param last: Duration of the last sample is unknown
+        :return: [buffer, ...]
+        """
+        samples = self._samples
+        self._samples = []
+        self._sequence += 1
+        entries = []
+        data = []
+        mdat_size = 0
+        for i, (units, keyframe, decode_time) in enumerate(samples):
+            if i + 1 < len(samples):
+                duration = samples[i + 1][2] - decode_time
+            elif last:
+                duration = self._duration
+            else:
+                duration = self._decode_time - decode_time
+            size = 0
+            for unit in units:  # Length prefixed NAL units instead of start codes
+                data.append(struct.pack('>I', len(unit)))
+                data.append(unit)
+                size += 4 + len(unit)
+            mdat_size += size
+            entries.append(struct.pack('>III', duration, size, SAMPLE_SYNC if keyframe else SAMPLE_NON_SYNC))
+        trun_size = 12 + 8 + 12 * len(entries)
+        traf_size = 8 + 16 + 20 + trun_size
+        moof_size = 8 + 16 + traf_size
+        moof = box(b'moof',
+                   full_box(b'mfhd', 0, 0, struct.pack('>I', self._sequence)),
+                   box(b'traf',
+                       full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),  # default-base-is-moof
+                       full_box(b'tfdt', 1, 0, struct.pack('>Q', samples[0][2])),
+                       # data-offset, sample-duration, sample-size, sample-flags present
+                       full_box(b'trun', 0, 0x000701, struct.pack('>Ii', len(entries), moof_size + 8), *entries)))
+        return [moof, struct.pack('>I4s', 8 + mdat_size, b'mdat')] + data
+
+    def _sample_entry(self, sets):
+        """
+        Visual sample entry 'avc1' or 'hvc1' with decoder configuration
+        :param sets: {'VPS', 'SPS', 'PPS'}
+        :return: (sample entry, width, height)
+        """
+        sps = sets['SPS']
+        pps = sets['PPS']
+        if self.hevc:
+            vps = sets['VPS']
+            info = h265_sps_info(sps)
+            width, height = info['width'], info['height']
+            arrays = b''.join(struct.pack('>BHH', 0x80 | nal_type, 1, len(unit)) + unit
+                              for nal_type, unit in ((32, vps), (33, sps), (34, pps)))
+            config = box(b'hvcC',
+                         struct.pack('>B', 1), info['profile_tier_level'][:1], info['profile_tier_level'][1:11],
+                         info['profile_tier_level'][11:12],
+                         struct.pack('>HBBBBHB', 0xF000, 0xFC, 0xFC | info['chroma_format'],
+                                     0xF8 | (info['bit_depth_luma'] - 8), 0xF8 | (info['bit_depth_chroma'] - 8),
+                                     0, (info['sub_layers'] << 3) | (info['temporal_id_nesting'] << 2) | 3),
+                         struct.pack('>B', 3), arrays)
+            kind = b'hvc1'
+        else:
+            width, height = h264_sps_size(sps)
+            config = box(b'avcC',
+                         struct.pack('>BBBBBB', 1, sps[1], sps[2], sps[3], 0xFF, 0xE1),
+                         struct.pack('>H', len(sps)), sps,
+                         struct.pack('>BH', 1, len(pps)), pps)
+            kind = b'avc1'
+        entry = box(kind,
+                    bytes(6), struct.pack('>H', 1),  # Reserved, data_reference_index
+                    bytes(16), struct.pack('>HH', width, height),
+                    struct.pack('>II', 0x00480000, 0x00480000), bytes(4), struct.pack('>H', 1),
+                    bytes(32), struct.pack('>Hh', 0x18, -1),
+                    config)
+        return entry, width, height
+
+    def init_segment(self, sets):
+        """
+        ftyp and moov boxes
+        :param sets: Parameter sets {'VPS', 'SPS', 'PPS'} without start codes
+        :return: bytes
+        """
+        entry, width, height = self._sample_entry(sets)
+        ftyp = box(b'ftyp', b'iso5', struct.pack('>I', 512), b'iso5', b'iso6', b'mp41')
+        mvhd = full_box(b'mvhd', 0, 0, struct.pack('>IIII', 0, 0, TIMESCALE, 0),
+                        struct.pack('>IH', 0x10000, 0x100), bytes(10), MATRIX, bytes(24), struct.pack('>I', 2))
+        tkhd = full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0), bytes(8),
+                        struct.pack('>hhhH', 0, 0, 0, 0), MATRIX, struct.pack('>II', width << 16, height << 16))
+        mdhd = full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0, 0x55C4, 0))  # 'und'
+        hdlr = full_box(b'hdlr', 0, 0, bytes(4), b'vide', bytes(12), b'VideoHandler\x00')
+        dinf = box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1)))
+        stbl = box(b'stbl',
+                   full_box(b'stsd', 0, 0, struct.pack('>I', 1), entry),
+                   full_box(b'stts', 0, 0, bytes(4)),
+                   full_box(b'stsc', 0, 0, bytes(4)),
+                   full_box(b'stsz', 0, 0, bytes(8)),
+                   full_box(b'stco', 0, 0, bytes(4)))
+        minf = box(b'minf', full_box(b'vmhd', 0, 1, bytes(8)), dinf, stbl)
+        trak = box(b'trak', tkhd, box(b'mdia', mdhd, hdlr, minf))
+        mvex = box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0)))
+        return ftyp + box(b'moov', mvhd, trak, mvex)
+
+
+MUXERS = {
+    'raw': AnnexB,
+    'mp4': FragmentedMP4,
+}
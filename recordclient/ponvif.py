@@ -10,9 +10,202 @@ import sys
 import time
 import uuid
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 from random import SystemRandom
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import pcache
+import pevents
+import pxml
+
+
+def make_http_session(retries=2, backoff=0.2, pool_size=4):
+    """
+    HTTP session with keep-alive connections to one camera.
+    Connection errors are retried for all requests, read errors and
+    statuses 502, 503, 504 only for GET (snapshots), SOAP requests are not repeated.
+    :param retries: Number of retries
+    :param backoff: Backoff factor of retries in seconds: 0.2, 0.4, 0.8 ...
+    :param pool_size: Maximum connections kept for concurrent requests
+    :return: requests.Session
+    """
+    options = {'total': retries, 'connect': retries, 'read': retries, 'status': retries,
+               'backoff_factor': backoff, 'status_forcelist': (502, 503, 504), 'raise_on_status': False}
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET']), **options)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET']), **options)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+MOTION_TOPICS = 'tns1:RuleEngine//.|tns1:VideoSource/MotionAlarm'  # Motion detection and analytics
+# Faults of CreatePullPointSubscription with a topic filter the camera does not support
+TOPIC_FAULTS = {'TopicExpressionDialectUnknownFault', 'InvalidTopicExpressionFault', 'TopicNotSupportedFault',
+                'InvalidFilterFault'}
+
+
+class SoapFault(Exception):
+    """
+    SOAP fault of the camera: the service is at the address, but the request is rejected
+    """
+    def __init__(self, text, codes):
+        """
+        :param text: Reason of the fault
+        :param codes: Set of the fault names, see pxml.fault_codes
+        """
+        super().__init__(text)
+        self.codes = codes
+
+
+def _remaining_time(resp):
+    """
+    :param resp: Response of CreatePullPointSubscription, Renew or PullMessages
+    :return: Seconds until TerminationTime by the clock of the camera or None
+    """
+    for current, termination in ((pxml.CURRENT_TIME, pxml.TERMINATION_TIME),
+                                 (pxml.WSNT_CURRENT_TIME, pxml.WSNT_TERMINATION_TIME)):
+        current_time = pevents.parse_time(pxml.find_text(resp, current))
+        termination_time = pevents.parse_time(pxml.find_text(resp, termination))
+        if current_time is not None and termination_time is not None:
+            return termination_time - current_time
+    return None
+
+
+class PullPointSubscription:
+    """
+    Pull point subscription of a camera. It is renewed before expiry. A subscription
+    that cannot be renewed or pulled is replaced: the new one is created before the old one
+    is removed, so there is no gap without a subscription.
+    """
+    def __init__(self, cam, topics=MOTION_TOPICS, duration=600, timeout=60):
+        """
+        :param cam: OnvifCam
+        :param topics: TopicExpression filter, empty - all events
+        :param duration: Seconds of subscription
+        :param timeout: Seconds of long poll
+        """
+        self.cam = cam
+        self.topics = topics
+        self.duration = duration
+        self.timeout = timeout
+        self.address = None
+        self.expires = 0  # time.monotonic()
+        self.lifetime = duration  # Seconds granted by the camera on subscribe or renew
+        self.renewals = 0
+        self.resubscriptions = 0
+
+    def _set_expiry(self, resp, default=None):
+        """
+        :param resp: Response with TerminationTime
+        :param default: Seconds granted if the response has no TerminationTime,
+        None - the response is not of subscribe or renew
+        """
+        remaining = _remaining_time(resp)
+        if remaining is None:
+            remaining = default
+        if remaining is not None:
+            self.expires = time.monotonic() + remaining
+            if default is not None:
+                self.lifetime = max(remaining, 1)
+
+    def _renew_at(self):
+        return self.expires - self.lifetime * 0.2  # At 80 % of the lifetime granted by the camera
+
+    def subscribe(self):
+        """
+        Create a new subscription, then remove the old one
+        """
+        try:
+            resp = self.cam._create_pull_point_subscription(self.topics, self.duration)
+        except SoapFault as error:
+            if not self.topics or not error.codes & TOPIC_FAULTS:
+                raise
+            logging.warning("Camera {}: topic filter is not supported: {}".format(self.cam.cache_key, error))
+            self.topics = ''
+            resp = self.cam._create_pull_point_subscription(self.topics, self.duration)
+        old = self.address
+        self.address = pxml.find_text(pxml.find(resp, pxml.SUBSCRIPTION_REFERENCE), pxml.ADDRESS)
+        self._set_expiry(resp, self.duration)
+        if old:
+            self.resubscriptions += 1
+            self.unsubscribe(old)
+
+    def renew(self):
+        try:
+            resp = self.cam._send_renew(self.address, self.duration)
+        except Exception as error:
+            logging.warning("Camera {}: renew failed: {!r}".format(self.cam.cache_key, error))
+            self.subscribe()
+            return
+        self._set_expiry(resp, self.duration)
+        self.renewals += 1
+
+    def pull(self):
+        """
+        Long poll of events, the subscription is made or renewed before
+        :return: [pevents.OnvifEvent, ...]
+        """
+        if self.address is None:
+            self.subscribe()
+        elif time.monotonic() >= self._renew_at():
+            self.renew()
+        timeout = max(1, min(self.timeout, self._renew_at() - time.monotonic()))
+        try:
+            resp = self.cam._send_pull_messages(self.address, timeout)
+        except Exception as error:
+            logging.warning("Camera {}: pull failed: {!r}".format(self.cam.cache_key, error))
+            self.subscribe()
+            return []
+        received = time.time()
+        self._set_expiry(resp)  # Some cameras prolong subscriptions by pulls
+        return pevents.parse_events(resp, received)
+
+    def unsubscribe(self, address=None):
+        """
+        :param address: Subscription, the current one by default
+        """
+        if address is None:
+            address, self.address = self.address, None
+        if not address:
+            return
+        try:
+            self.cam._send_unsubscribe(address)
+        except Exception as error:
+            logging.warning("Unsubscribe {}: {!r}".format(address, error))
+
+
+def _open_camera(config, stream_uri):
+    cam = OnvifCam(config)
+    if stream_uri:
+        cam.get_stream_uri()
+    return cam
+
+
+def open_cameras(configs, workers=64, stream_uri=False):
+    """
+    Initialize many cameras concurrently, the start time is the time of the slowest camera
+    :param configs: {name: config of OnvifCam}
+    :param workers: Maximum cameras initialized at once
+    :param stream_uri: Request stream uri too
+    :return: {name: OnvifCam}, failed cameras are logged and skipped
+    """
+    cameras = {}
+    if not configs:
+        return cameras
+    with ThreadPoolExecutor(max_workers=min(workers, len(configs))) as executor:
+        futures = {name: executor.submit(_open_camera, config, stream_uri) for name, config in configs.items()}
+        for name, future in futures.items():
+            try:
+                cameras[name] = future.result()
+            except Exception as error:
+                logging.error("Camera {}: ONVIF init failed: {!r}".format(name, error))
+    return cameras
 
 
 class OnvifCam:
@@ -26,6 +219,32 @@ class OnvifCam:
         except:
             logging.error("Error Camera config")
             raise Exception("Error config")
+        connect_timeout = config.get('http_connect_timeout')  # Seconds
+        read_timeout = config.get('http_read_timeout')  # Seconds, PullMessages waits longer by its timeout
+        self.http_timeout = (float(connect_timeout) if connect_timeout else 3,
+                             float(read_timeout) if read_timeout else 10)
+        retries = config.get('http_retries')
+        backoff = config.get('http_backoff')
+        self.session = make_http_session(int(retries) if retries else 2, float(backoff) if backoff else 0.2)
+        cache_file = config.get('onvif_cache')  # JSON file of capabilities, profiles and uri, empty - no cache
+        cache_ttl = config.get('onvif_cache_ttl')  # Seconds, older entries are checked by device information
+        self.cache = pcache.MetadataCache(cache_file, float(cache_ttl) if cache_ttl else 86400) if cache_file else None
+        self.cache_key = '{}:{}'.format(self.ip, self.port)
+        self.cached = False
+        self.device = None
+        self.stream_uri = None
+        self._date_time = None  # (get_system_date_time(), local time) requested on start
+        self.motion_latency = pevents.LatencyStats()  # Camera time of motion events to local receipt
+        self.event_topics = config.get('event_topics', MOTION_TOPICS)  # TopicExpression, empty - all events
+        duration = config.get('event_subscription')  # Seconds of subscription, it is renewed before expiry
+        self.event_duration = int(duration) if duration else 600
+        timeout = config.get('event_timeout')  # Seconds of long poll of events
+        self.event_timeout = int(timeout) if timeout else 60
+        if not self._load_cache():
+            self._query_metadata()
+            self._save_cache()
+
+    def _query_metadata(self):
         self.capabilities = {}
         cap = self.get_capabilities()
         for k in cap.keys():
@@ -41,11 +260,92 @@ class OnvifCam:
                     else:
                         for n in cap[k][m].keys():
                             self.capabilities[n] = cap[k][m][n]['xaddr']
-        self.profiles = self.get_profiles()
-        self.profilename = list(self.profiles[0].keys())[0]
-        self.profiletoken = self.profiles[0][self.profilename]
-        self.profile_settings = self.get_profile_settings(self.profiletoken)
-        self.snapshot_uri = self.get_snapshot_uri()
+        # Only GetCapabilities must be first, the rest is requested concurrently in two steps.
+        # GetStreamUri is requested by get_stream_uri() when it is needed.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # The device is the key of the cache, some cameras reject GetDeviceInformation of the user
+            device = executor.submit(self.get_device_information) if self.cache is not None else None
+            profiles = executor.submit(self.get_profiles)
+            date_time = executor.submit(self.get_system_date_time)
+            self.profiles = profiles.result()
+            self.profilename = list(self.profiles[0].keys())[0]
+            self.profiletoken = self.profiles[0][self.profilename]
+            settings = executor.submit(self.get_profile_settings, self.profiletoken)
+            snapshot_uri = executor.submit(self.get_snapshot_uri)
+            if device is not None:
+                try:
+                    self.device = self._device_id(device.result())
+                except Exception as error:
+                    logging.warning("Camera {}: no device information: {!r}".format(self.cache_key, error))
+            self.profile_settings = settings.result()
+            self.snapshot_uri = snapshot_uri.result()
+            try:
+                self._date_time = (date_time.result(), datetime.datetime.now())
+            except Exception as error:
+                logging.warning("Camera {}: no date and time: {!r}".format(self.cache_key, error))
+
+    @staticmethod
+    def _device_id(information):
+        """
+        :param information: Result of get_device_information()
+        :return: 'manufacturer/model/serial number/firmware version'
+        """
+        return '/'.join(information.get(i) or '' for i in ('manufacturer', 'model',
+                                                          'serialnumber', 'firmwareversion'))
+
+    def _load_cache(self):
+        """
+        Take capabilities, profiles and uri from the cache. An entry older than ttl is used
+        if the device and its firmware are the same, one request instead of all.
+        :return: True if loaded
+        """
+        if self.cache is None:
+            return False
+        entry = self.cache.get(self.cache_key)
+        if not entry:
+            return False
+        try:
+            self.capabilities = entry['capabilities']
+            if not self.cache.is_fresh(entry):
+                device = self._device_id(self.get_device_information())
+                if device != entry['device']:
+                    logging.warning("Camera {} changed: {} -> {}".format(self.cache_key, entry['device'], device))
+                    return False
+                self.cache.put(self.cache_key, entry)
+            self.device = entry['device']
+            self.profiles = entry['profiles']
+            self.profilename = entry['profilename']
+            self.profiletoken = entry['profiletoken']
+            self.profile_settings = entry['profile_settings']
+            self.snapshot_uri = entry['snapshot_uri']
+            self.stream_uri = entry.get('stream_uri')
+        except Exception as error:
+            logging.warning("Camera {}: cache is not used: {!r}".format(self.cache_key, error))
+            return False
+        self.cached = True
+        return True
+
+    def _save_cache(self):
+        if self.cache is None:
+            return
+        self.cache.put(self.cache_key, {'device': self.device,
+                                        'capabilities': self.capabilities,
+                                        'profiles': self.profiles,
+                                        'profilename': self.profilename,
+                                        'profiletoken': self.profiletoken,
+                                        'profile_settings': self.profile_settings,
+                                        'snapshot_uri': self.snapshot_uri,
+                                        'stream_uri': self.stream_uri})
+
+    def invalidate_cache(self):
+        """
+        Remove the camera from the cache, the next start requests everything.
+        It is called when a request with the cached data fails.
+        """
+        if self.cached:
+            logging.warning("Camera {}: request with cached data failed, cache removed".format(self.cache_key))
+            self.cache.invalidate(self.cache_key)
+            self.cached = False
 
     def onvif_auth_header(self):
         created = datetime.datetime.now().isoformat().split(".")[0]
@@ -74,41 +374,35 @@ class OnvifCam:
             soapmsg = envelope.format(body)
         return soapmsg
 
-    def _send_request(self, url, msg):
-        headers = {'Content-Type': 'application/soap+xml; charset=utf-8'}
-        # TODO: try: request except:
-        response = requests.post(url, msg, headers=headers)
-        # TODO: change return {'error': False, 'response': BeautifulSoup(response.content, 'html.parser')}
-        if response.status_code == 200:
-            return  BeautifulSoup(response.content, 'html.parser')
-        elif response.status_code == 400:
-            resp = BeautifulSoup(response.content, 'html.parser')
-            print(resp.prettify())
-            raise Exception(resp.find('soap-env:text').text)
-        else:
-            print(response.content.decode())
-            raise Exception("Status code: ", response.status_code)
+    def close(self):
+        """
+        Close connections to the camera
+        """
+        self.session.close()
 
-    def _get_all_node_recursively(self, rt, res):
+    def _send_request(self, url, msg, timeout=None):
+        headers = {'Content-Type': 'application/soap+xml; charset=utf-8'}
         try:
-            name = (rt.name).split(':')[1]
-        except:
-            name = rt.name
-        if len(list(rt.findChildren())) == 0:
-            res[name] = rt.text
-        else:
-            res[name] = {}
-            for i in rt.contents:
-                self._get_all_node_recursively(i, res[name])
+            response = self.session.post(url, msg, headers=headers, timeout=timeout or self.http_timeout)
+        except requests.ConnectionError:
+            self.invalidate_cache()
+            raise
+        if response.status_code == 200:
+            return pxml.parse(response.content)
+        fault = pxml.fault_text(response.content)
+        if fault is not None:  # The service is at the address, i.e. an unsupported filter
+            print(pxml.prettify(pxml.parse(response.content)))
+            raise SoapFault(fault, pxml.fault_codes(response.content))
+        self.invalidate_cache()  # No service at the address
+        print(response.content.decode())
+        raise Exception("Status code: ", response.status_code)
 
     def get_capabilities(self):
         url = 'http://{ip}:{port}/onvif/'.format(ip=self.ip, port=self.port)
         msg = '<GetCapabilities xmlns="http://www.onvif.org/ver10/device/wsdl">' \
               '<Category>All</Category></GetCapabilities>'
         resp = self._send_request(url, self._create_soap_msg(msg))
-        result = {}
-        self._get_all_node_recursively(resp.find('tds:capabilities'), result)
-        return result['capabilities']
+        return pxml.to_dict(pxml.find(resp, pxml.CAPABILITIES))['capabilities']
 
     def get_profiles(self):
         service = 'media'
@@ -116,11 +410,8 @@ class OnvifCam:
         msg = '<GetProfiles xmlns="http://www.onvif.org/ver10/media/wsdl"/>'
         resp = self._send_request(url, self._create_soap_msg(msg))
         result = []
-        for p in resp.find_all('trt:profiles'):
-            prof = p.findChild('tt:name')
-            pr = {}
-            pr[prof.text] = p.attrs['token']
-            result.append(pr)
+        for p in resp.iter(pxml.PROFILES):
+            result.append({pxml.find_text(p, pxml.NAME): p.get('token')})
         return result
 
     def get_profile_settings(self, token):
@@ -130,24 +421,21 @@ class OnvifCam:
         msg = '<GetProfile xmlns="http://www.onvif.org/ver10/media/wsdl">' \
               '{}</GetProfile>'.format(profiletoken)
         resp = self._send_request(url, self._create_soap_msg(msg))
-        return resp
+        return pxml.to_dict(pxml.find(resp, pxml.PROFILE))['profile']
 
     def get_device_information(self):
         service = 'device'
         url = self.capabilities[service]
         msg = '<GetDeviceInformation xmlns="http://www.onvif.org/ver10/device/wsdl"/>'
         resp = self._send_request(url, self._create_soap_msg(msg))
-        result = {}
-        self._get_all_node_recursively(resp.find('tds:getdeviceinformationresponse'), result)
-        return result['getdeviceinformationresponse']
+        return pxml.to_dict(pxml.find(resp, pxml.DEVICE_INFORMATION))['getdeviceinformationresponse']
 
     def get_system_date_time(self):
         service = 'device'
         url = self.capabilities[service]
         msg = '<GetSystemDateAndTime xmlns="http://www.onvif.org/ver10/device/wsdl"/>'
         resp = self._send_request(url, self._create_soap_msg(msg))
-        sdt = {}
-        self._get_all_node_recursively(resp.find('tds:systemdateandtime'), sdt)
+        sdt = pxml.to_dict(pxml.find(resp, pxml.SYSTEM_DATE_TIME))
         result = {}
         result['timezone'] = sdt['systemdateandtime']['timezone']['tz']
         camera_date = sdt['systemdateandtime']['localdatetime']['date']
@@ -189,8 +477,13 @@ class OnvifCam:
         self._send_request(url, self._create_soap_msg(msg))
 
     def synchronization_date_time(self, delta=1):
-        camera_datetime = self.get_system_date_time()
-        camera_time = camera_datetime['datetime']
+        if self._date_time:  # Requested on start, the camera time is moved on by the local time
+            camera_datetime, received = self._date_time
+            self._date_time = None
+            camera_time = camera_datetime['datetime'] + (datetime.datetime.now() - received)
+        else:
+            camera_datetime = self.get_system_date_time()
+            camera_time = camera_datetime['datetime']
         camera_timezone = camera_datetime['timezone']
         current_time = datetime.datetime.now()
         allowed_divergence = datetime.timedelta(minutes=delta)
@@ -203,8 +496,8 @@ class OnvifCam:
         msg = '<GetServiceCapabilities xmlns="http://www.onvif.org/ver10/device/wsdl"></GetServiceCapabilities>'
         resp = self._send_request(url, self._create_soap_msg(msg))
         result = {}
-        for i in resp.find('tds:capabilities').contents:
-            result[(i.name).split(':')[1]] = i.attrs
+        for i in pxml.find(resp, pxml.CAPABILITIES):
+            result[pxml.local_name(i.tag)] = pxml.attributes(i)
         return result
 
     def get_video_sources(self):
@@ -212,11 +505,16 @@ class OnvifCam:
         url = self.capabilities[service]
         msg = '<GetVideoSources xmlns="http://www.onvif.org/ver10/media/wsdl"/>'
         resp = self._send_request(url, self._create_soap_msg(msg))
-        result = {}
-        self._get_all_node_recursively(resp.find('trt:videosources'), result)
-        return result['videosources']
+        return pxml.to_dict(pxml.find(resp, pxml.VIDEO_SOURCES))['videosources']
 
     def get_stream_uri(self):
+        if not self.stream_uri:
+            self.stream_uri = self._request_stream_uri()
+            if self.cache is not None:
+                self.cache.update(self.cache_key, {'stream_uri': self.stream_uri})
+        return self.stream_uri
+
+    def _request_stream_uri(self):
         service = 'media'
         url = self.capabilities[service]
         stream = '<Stream xmlns="http://www.onvif.org/ver10/schema">RTP-Unicast</Stream>'
@@ -227,7 +525,7 @@ class OnvifCam:
         msg = '<GetStreamUri xmlns="http://www.onvif.org/ver10/media/wsdl">' \
               '{s}{p}</GetStreamUri>'.format(s=streamsetup, p=profiletoken)
         resp = self._send_request(url, self._create_soap_msg(msg))
-        return resp.find('tt:uri').text
+        return pxml.find_text(resp, pxml.URI)
 
     def _create_head_pull_messages(self, urlact, urlto):
         action = '<a:Action s:mustUnderstand="1">{}</a:Action>'.format(urlact)
@@ -237,25 +535,36 @@ class OnvifCam:
         header = '<s:Header>{a}{m}{r}{t}</s:Header>'.format(a=action, m=massage_id, r=reply_to, t=to)
         return header
 
-    def _convert_str_to_bool(self, string):
-        if string.lower() == 'false':
-            return False
-        else:
-            return True
-
-    def _send_pull_messages(self, url):
+    def _send_pull_messages(self, url, timeout=60):
+        """
+        :param url: Address of the subscription
+        :param timeout: Seconds of the long poll, the camera answers earlier if it has events
+        :return: Element of the response
+        """
         url_action = 'http://www.onvif.org/ver10/events/wsdl/PullPointSubscription/PullMessagesRequest'
         head = self._create_head_pull_messages(url_action, url)
-        self.timeout = 'PT1M'
         self.msglimit = 1024
-        tmout = '<Timeout>{}</Timeout>'.format(self.timeout)
+        tmout = '<Timeout>PT{}S</Timeout>'.format(int(timeout))
         messagelimit = '<MessageLimit>{}</MessageLimit>'.format(self.msglimit)
         msg = '<PullMessages xmlns="http://www.onvif.org/ver10/events/wsdl">' \
               '{t}{m}</PullMessages>'.format(t=tmout, m=messagelimit)
         a = self._create_soap_msg(msg, head)
-        resp = self._send_request(url, a)
+        http_timeout = (self.http_timeout[0], self.http_timeout[1] + timeout)  # Camera answers in timeout without events
+        resp = self._send_request(url, a, http_timeout)
         return resp
 
+    def _send_renew(self, url, duration):
+        """
+        :param url: Address of the subscription
+        :param duration: Seconds
+        :return: Element of the response
+        """
+        url_action = 'http://docs.oasis-open.org/wsn/bw-2/SubscriptionManager/RenewRequest'
+        head = self._create_head_pull_messages(url_action, url)
+        msg = '<Renew xmlns="http://docs.oasis-open.org/wsn/b-2">' \
+              '<TerminationTime>PT{}S</TerminationTime></Renew>'.format(int(duration))
+        return self._send_request(url, self._create_soap_msg(msg, head))
+
     def _send_unsubscribe(self, url):
         url_action = 'http://docs.oasis-open.org/wsn/bw-2/SubscriptionManager/UnsubscribeRequest'
         head = self._create_head_pull_messages(url_action, url)
@@ -263,34 +572,76 @@ class OnvifCam:
         a = self._create_soap_msg(msg, head)
         self._send_request(url, a)
 
-    def _create_pull_point_subscription(self):
+    def _create_pull_point_subscription(self, topics='', duration=600):
+        """
+        :param topics: TopicExpression of the ConcreteSet dialect, empty - all topics
+        :param duration: Seconds
+        :return: Element of the response
+        """
         service = 'events'
         url = self.capabilities[service]
         url_action = 'http://www.onvif.org/ver10/events/wsdl/EventPortType/CreatePullPointSubscriptionRequest'
+        topic_filter = ''
+        if topics:
+            topic_filter = '<Filter><TopicExpression xmlns="http://docs.oasis-open.org/wsn/b-2" ' \
+                           'xmlns:tns1="http://www.onvif.org/ver10/topics" ' \
+                           'Dialect="http://www.onvif.org/ver10/tev/topicExpression/ConcreteSet">' \
+                           '{}</TopicExpression></Filter>'.format(topics)
         bmsg = '<CreatePullPointSubscription xmlns="http://www.onvif.org/ver10/events/wsdl">' \
-               '<InitialTerminationTime>PT600S</InitialTerminationTime></CreatePullPointSubscription>'
+               '{f}<InitialTerminationTime>PT{d}S</InitialTerminationTime>' \
+               '</CreatePullPointSubscription>'.format(f=topic_filter, d=int(duration))
         h = self._create_head_pull_messages(url_action, url)
         msg = self._create_soap_msg(bmsg, h)
-        resp = self._send_request(url, msg)
-        addr = resp.find('tev:subscriptionreference').findChild('wsa5:address').text
-        return addr
+        return self._send_request(url, msg)
+
+    def pull_events(self, stop=None):
+        """
+        Events of a pull point subscription. PullMessages is a long poll: the camera answers
+        as soon as it has events or after its timeout, so requests follow each other without pauses.
+        The subscription is renewed and replaced by PullPointSubscription, errors are retried.
+        Send True to the generator to stop.
+        :param stop: Event, checked after every response
+        :return: generator of pevents.OnvifEvent, all messages of every response
+        """
+        subscription = PullPointSubscription(self, self.event_topics, self.event_duration, self.event_timeout)
+        delay = 0
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    events = subscription.pull()
+                    delay = 0
+                except Exception as error:
+                    delay = min(delay * 2 or 1, 30)
+                    logging.warning("Camera {}: events: {!r}, retry in {} s".format(self.cache_key, error, delay))
+                    time.sleep(delay)
+                    continue
+                for event in events:
+                    if (yield event):
+                        return
+        finally:
+            subscription.unsubscribe()
 
     def run_detect_motion(self):
-        url = self._create_pull_point_subscription()
-        stop = False
+        """
+        State of motion on every motion event, latency is in self.motion_latency.
+        Send True to the generator to stop.
+        :return: generator of bool
+        """
+        events = self.pull_events()
         try:
-            while not stop:
-                resp = self._send_pull_messages(url)
-                data = resp.find('tt:data')
-                motion = (data.findChild().attrs)['value']
-                stop = yield self._convert_str_to_bool(motion)
-                time.sleep(0.5)
+            for event in events:
+                motion = event.motion
+                if motion is None:
+                    continue
+                self.motion_latency.add(event.latency)
+                if (yield motion):
+                    break
         except KeyboardInterrupt:
             pass
-        except:
+        except Exception:
             logging.error("run_detect_motion - Exception: {}".format(sys.exc_info()[0]))
         finally:
-            self._send_unsubscribe(url)
+            events.close()
 
     def get_snapshot_uri(self):
         """
@@ -303,7 +654,7 @@ class OnvifCam:
         msg = '<GetSnapshotUri xmlns="http://www.onvif.org/ver10/media/wsdl">' \
               '{}</GetSnapshotUri>'.format(profiletoken)
         resp = self._send_request(url, self._create_soap_msg(msg))
-        snapshot_url = resp.find('tt:uri').text
+        snapshot_url = pxml.find_text(resp, pxml.URI)
         return snapshot_url
 
     def get_snapshot(self, uri=''):
@@ -311,17 +662,17 @@ class OnvifCam:
             url = uri
         else:
             url = self.snapshot_uri
-        try:
-            attempts = 2
-            while attempts > 0:
-                response = requests.get(url)
-                if response.status_code == 200:
-                    break
-        except requests.ConnectionError():
-            logging.error("Connection error: ", url)
+        try:  # Retries are made by the session
+            response = self.session.get(url, timeout=self.http_timeout)
+        except requests.RequestException as error:
+            logging.error("Get snapshot {}: {}".format(url, error))
+            if url == self.snapshot_uri:
+                self.invalidate_cache()
             return None
-        if not response or response.status_code != 200:
-            logging.error("Get snapshot request.status_code: ", response.status_code)
+        if response.status_code != 200:
+            logging.error("Get snapshot request.status_code: {}".format(response.status_code))
+            if url == self.snapshot_uri:
+                self.invalidate_cache()
             return None
         return response.content
 
@@ -352,13 +703,11 @@ class OnvifCam:
         msg = '<GetRules xmlns="http://www.onvif.org/ver20/analytics/wsdl">' \
               '{}</GetRules>'.format(profiletoken)
         resp = self._send_request(url, self._create_soap_msg(msg))
-        rule = resp.find('tan:rule').attrs
-        result = {'rule_name': rule['name'], 'rule_type': rule['type']}
-        items = resp.find_all('tt:simpleitem')
+        rule = pxml.find(resp, pxml.RULE)
+        result = {'rule_name': rule.get('Name'), 'rule_type': rule.get('Type')}
         params = {}
-        for i in items:
-            p = i.attrs
-            params.update({p['name']:p['value']})
+        for i in resp.iter(pxml.SIMPLE_ITEM):
+            params.update({i.get('Name'): i.get('Value')})
         result['parameters'] = params
         return result
 
@@ -381,7 +730,7 @@ class OnvifCam:
         msg = '<ModifyRules xmlns="http://www.onvif.org/ver20/analytics/wsdl">' \
               '{p}{r}</ModifyRules>'.format(p=profiletoken, r=rule)
         resp = self._send_request(url, self._create_soap_msg(msg, header=self.onvif_auth_header()))
-        return resp.prettify()
+        return pxml.prettify(resp)
 
     def get_analytics_modules(self):
         service = 'analytics'
@@ -391,4 +740,4 @@ class OnvifCam:
         msg = '<GetAnalyticsModules xmlns="http://www.onvif.org/ver20/analytics/wsdl">' \
               '{}</GetAnalyticsModules>'.format(profiletoken)
         resp = self._send_request(url, self._create_soap_msg(msg))
-        return resp.prettify()
\ No newline at end of file
+        return pxml.prettify(resp)
\ No newline at end of file
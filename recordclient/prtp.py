@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+import selectors
+import socket
+import struct
+import time
+
+from collections import deque
+
+
+START_CODE = b'\x00\x00\x00\x01'  # This is the sequence of four bytes that identifies a NAL packet
+RTP_HEADER = struct.Struct('!BBHII')  # V/P/X/CC, M/PT, sequence number, timestamp, ssrc
+MAX_DROPOUT = 3000  # RFC 3550 A.1
+MAX_MISORDER = 100
+INTERLEAVED_HEADER = struct.Struct('!cBH')  # '$', channel, length (RFC 2326 10.12)
+
+
+def parse_rtp_header(view):
+    """
+    Parse the fixed RTP header and skip CSRC list, header extension and padding.
+    :param view: memoryview of the RTP packet
+    :return: (marker, payload type, sequence number, timestamp, ssrc, payload begin, payload end)
+             or None for malformed packet
+    """
+    size = len(view)
+    if size < 12:
+        return None
+    b0, b1, sn, timestamp, ssrc = RTP_HEADER.unpack_from(view)
+    if b0 >> 6 != 2:
+        return None
+    begin = 12 + (b0 & 0x0F) * 4  # Skip CSRC identifiers
+    if b0 & 0x10:  # X (additional header)
+        if size < begin + 4:
+            return None
+        hlen = (view[begin + 2] << 8) | view[begin + 3]
+        begin += 4 + hlen * 4
+    end = size
+    if b0 & 0x20:  # P (padding), last byte is a padding length
+        end -= view[size - 1]
+    if begin >= end:
+        return None
+    return b1 >> 7, b1 & 0x7F, sn, timestamp, ssrc, begin, end
+
+
+def aggregated_units(view, begin, end):
+    """
+    Split payload of an aggregation packet (STAP-A, H265 AP) into NAL units
+    :param view: memoryview of the RTP packet
+    :param begin: Begin of the first NAL unit size field
+    :param end: End of payload
+    :return: [memoryview of NAL unit, ...]
+    """
+    units = []
+    while begin + 2 < end:
+        size = (view[begin] << 8) | view[begin + 1]
+        begin += 2
+        if not size or begin + size > end:
+            break
+        units.append(view[begin:begin + size])
+        begin += size
+    return units
+
+
+class H264Depacketizer:
+    """
+    Depacketization RTP payload H264 (RFC 6184).
+    Header is read with struct and integer operations, payload is returned
+    as memoryview of the packet without copying.
+    """
+    codec = 'H264'
+    extension = 'h264'
+    parameter_types = {7: 'SPS', 8: 'PPS'}
+    keyframe_types = frozenset((5, 7))  # IDR, SPS
+
+    def __init__(self):
+        # Cached NAL "stamps" for FU-A start fragments: start code + reconstructed NAL header
+        self._fu_heads = {}
+
+    def _fu_head(self, nal_header):
+        head = self._fu_heads.get(nal_header)
+        if head is None:
+            head = START_CODE + bytes((nal_header,))
+            self._fu_heads[nal_header] = head
+        return head
+
+    def nal_type(self, unit):
+        """
+        :param unit: NAL unit
+        :return: NAL unit type
+        """
+        return unit[0] & 0x1F
+
+    def depacketize(self, packet):
+        """
+        This routine takes a UDP packet, i.e. a string of bytes and ..
+            1) strips off the RTP header
+            2) makes NAL "stamps" for the packets, so that they are recognized as NAL's
+            3) returns payload without copying
+        Writing 'head' and then 'data' gives a packet that can be written to disk as such
+        and that is recognized by stock media players as h264 stream.
+        :param packet: RTP packet (bytes, bytearray or memoryview)
+        :return: {'typ': 'SPS' | 'PPS' | 'UNKW' | 'FU' | 'AP',
+                  'start': start of frame (FU only), 'end': end of the frame (FU only),
+                  'head': bytes written before data,
+                  'data': memoryview of payload,
+                  'units': [memoryview of NAL unit, ...] (AP only, without 'head' and 'data'),
+                  'nal': NAL unit type, 'marker', 'seq', 'timestamp'}
+                 or None for unsupported packet
+        """
+        view = packet if isinstance(packet, memoryview) else memoryview(packet)
+        header = parse_rtp_header(view)
+        if header is None:
+            logging.error("Malformed RTP packet ({} bytes)".format(len(view)))
+            return None
+        marker, pt, sn, timestamp, ssrc, begin, end = header
+        fb = view[begin]  # "First byte" a NAL packet: [F | NRI | Type]
+        typ = fb & 0x1F
+        result = {'marker': marker, 'seq': sn, 'timestamp': timestamp}
+        if typ <= 23:
+            result['typ'] = self.parameter_types.get(typ, 'UNKW')
+            result['nal'] = typ
+            result['head'] = START_CODE
+            result['data'] = view[begin:end]
+            return result
+        if typ == 28:  # FU-A
+            if end - begin < 2:
+                return None
+            sb = view[begin + 1]  # "Second byte": [S | E | R | Type]
+            start = bool(sb & 0x80)
+            result['typ'] = 'FU'
+            result['start'] = start  # Start of frame
+            result['end'] = bool(sb & 0x40)  # End of the frame
+            result['nal'] = sb & 0x1F
+            if start:
+                result['head'] = self._fu_head((fb & 0xE0) | (sb & 0x1F))  # [3 NAL UNIT BITS | 5 NAL UNIT BITS]
+            else:
+                result['head'] = b''
+            result['data'] = view[begin + 2:end]
+            return result
+        if typ == 24:  # STAP-A
+            result['typ'] = 'AP'
+            result['nal'] = typ
+            result['units'] = aggregated_units(view, begin + 1, end)
+            return result
+        logging.error("Unknown frame type ({}) for this fragment".format(typ))
+        return None
+
+
+class H265Depacketizer(H264Depacketizer):
+    """
+    Depacketization RTP payload H265 (RFC 7798) without DONL fields.
+    """
+    codec = 'H265'
+    extension = 'h265'
+    parameter_types = {32: 'VPS', 33: 'SPS', 34: 'PPS'}
+    keyframe_types = frozenset(range(16, 24)) | {32}  # IRAP pictures (BLA, IDR, CRA), VPS
+
+    def nal_type(self, unit):
+        return (unit[0] >> 1) & 0x3F
+
+    def depacketize(self, packet):
+        """
+        See H264Depacketizer.depacketize
+        """
+        view = packet if isinstance(packet, memoryview) else memoryview(packet)
+        header = parse_rtp_header(view)
+        if header is None:
+            logging.error("Malformed RTP packet ({} bytes)".format(len(view)))
+            return None
+        marker, pt, sn, timestamp, ssrc, begin, end = header
+        if end - begin < 3:
+            return None
+        fb = view[begin]  # Payload header: [F | Type | LayerId | TID]
+        typ = (fb >> 1) & 0x3F
+        result = {'marker': marker, 'seq': sn, 'timestamp': timestamp}
+        if typ < 48:
+            result['typ'] = self.parameter_types.get(typ, 'UNKW')
+            result['nal'] = typ
+            result['head'] = START_CODE
+            result['data'] = view[begin:end]
+            return result
+        if typ == 49:  # FU
+            fu = view[begin + 2]  # FU header: [S | E | FuType]
+            start = bool(fu & 0x80)
+            result['typ'] = 'FU'
+            result['start'] = start
+            result['end'] = bool(fu & 0x40)
+            result['nal'] = fu & 0x3F
+            if start:
+                nal_header = (((fb & 0x81) | ((fu & 0x3F) << 1)) << 8) | view[begin + 1]
+                result['head'] = self._fu_head(nal_header)
+            else:
+                result['head'] = b''
+            result['data'] = view[begin + 3:end]
+            return result
+        if typ == 48:  # AP
+            result['typ'] = 'AP'
+            result['nal'] = typ
+            result['units'] = aggregated_units(view, begin + 2, end)
+            return result
+        logging.error("Unknown frame type ({}) for this fragment".format(typ))
+        return None
+
+    def _fu_head(self, nal_header):
+        head = self._fu_heads.get(nal_header)
+        if head is None:
+            head = START_CODE + nal_header.to_bytes(2, 'big')
+            self._fu_heads[nal_header] = head
+        return head
+
+
+DEPACKETIZERS = {
+    'H264': H264Depacketizer,
+    'H265': H265Depacketizer,
+    'HEVC': H265Depacketizer,
+}
+
+
+def get_depacketizer(codec):
+    """
+    Depacketizer for the encoding name of SDP 'rtpmap' attribute
+    :param codec: Encoding name, i.e. 'H264'
+    :return: Depacketizer or None for unsupported codec
+    """
+    depacketizer = DEPACKETIZERS.get(codec.upper())
+    if depacketizer is None:
+        return None
+    return depacketizer()
+
+
+class UDPReceiver:
+    """
+    Batched receive of RTP datagrams into a preallocated buffer pool.
+    One wakeup drains all the datagrams queued in the socket (up to 'batch')
+    with recv_into, without allocation of bytes per packet.
+    """
+    def __init__(self, sock, batch=64, slot_size=4096):
+        """
+        :param sock: UDP socket, timeout of the socket is used as the receive timeout
+        :param batch: Maximum number of datagrams per wakeup (size of the pool)
+        :param slot_size: Maximum size of datagram
+        """
+        self.sock = sock
+        self.timeout = sock.gettimeout()
+        sock.setblocking(False)
+        self._pool = bytearray(batch * slot_size)
+        view = memoryview(self._pool)
+        self._slots = [view[i * slot_size:(i + 1) * slot_size] for i in range(batch)]
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def receive(self):
+        """
+        Wait datagrams and read all of them that are already queued.
+        Packets are memoryviews of the pool and valid until the next call,
+        copy data which must be kept longer.
+        :return: [packet, ...]
+        """
+        if not self._selector.select(self.timeout):
+            raise socket.timeout('timed out')
+        packets = []
+        recv_into = self.sock.recv_into
+        for slot in self._slots:
+            try:
+                size = recv_into(slot)
+            except BlockingIOError:
+                break
+            packets.append(slot[:size])
+        return packets
+
+    def close(self):
+        self._selector.close()
+
+
+class InterleavedDemuxer:
+    """
+    Demultiplexer of RTP packets interleaved in the RTSP connection ('$' frames).
+    Data is received into one buffer and packets are memoryviews of it,
+    RTSP messages between the frames (responses to keepalive) are kept in 'messages'.
+    """
+    def __init__(self, channel=0, size=262144):
+        """
+        :param channel: Interleaved channel of RTP packets, other channels (RTCP) are skipped
+        :param size: Size of the buffer, at least one maximum frame
+        """
+        self.channel = channel
+        self._buffer = bytearray(max(size, 2 * (INTERLEAVED_HEADER.size + 0xFFFF)))
+        self._view = memoryview(self._buffer)
+        self._begin = 0  # Beginning of the data which is not parsed
+        self._end = 0  # End of the received data
+        self.messages = deque(maxlen=16)
+        self.skipped = 0  # Frames of other channels
+
+    def free(self):
+        """
+        Space for receiving, the data which is not parsed is moved to the beginning of the buffer.
+        Packets of the previous call of packets() become invalid.
+        :return: memoryview for recv_into
+        """
+        if self._begin:
+            rest = self._end - self._begin
+            self._buffer[:rest] = self._view[self._begin:self._end]
+            self._begin = 0
+            self._end = rest
+        return self._view[self._end:]
+
+    def commit(self, size):
+        """
+        :param size: Size of the data received into free()
+        :return: None
+        """
+        self._end += size
+
+    def feed(self, data):
+        """
+        Copy received data and parse it
+        :param data: bytes-like
+        :return: [packet, ...] see packets()
+        """
+        view = memoryview(data)
+        packets = []
+        while len(view):
+            if packets:  # free() moves the data
+                packets = [bytes(p) for p in packets]
+            space = self.free()
+            size = min(len(space), len(view))
+            space[:size] = view[:size]
+            self.commit(size)
+            view = view[size:]
+            packets.extend(self.packets())
+        return packets
+
+    def packets(self):
+        """
+        Parse the received data
+        :return: [packet, ...] - memoryviews of the buffer valid until the next call of free() or feed()
+        """
+        packets = []
+        buffer = self._buffer
+        view = self._view
+        pos = self._begin
+        end = self._end
+        while end - pos >= INTERLEAVED_HEADER.size:
+            if buffer[pos] != 0x24:  # Not '$', RTSP message
+                head = buffer.find(b'\r\n\r\n', pos, end)
+                if head < 0:
+                    if end - pos > len(buffer) // 2:  # Not RTSP, resync on the next '$'
+                        found = buffer.find(b'$', pos + 1, end)
+                        pos = found if found >= 0 else end
+                        continue
+                    break
+                head += 4
+                message = bytes(view[pos:head]).decode(errors='replace')
+                length = re.search(r'Content-Length:\s*(\d+)', message, re.IGNORECASE)
+                if length:
+                    if head + int(length.group(1)) > end:
+                        break
+                    head += int(length.group(1))
+                    message = bytes(view[pos:head]).decode(errors='replace')
+                self.messages.append(message)
+                pos = head
+                continue
+            _, channel, length = INTERLEAVED_HEADER.unpack_from(buffer, pos)
+            if end - pos < INTERLEAVED_HEADER.size + length:
+                break
+            pos += INTERLEAVED_HEADER.size
+            if channel == self.channel:
+                packets.append(view[pos:pos + length])
+            else:
+                self.skipped += 1
+            pos += length
+        self._begin = pos
+        return packets
+
+
+class InterleavedReceiver:
+    """
+    Receive of RTP packets interleaved in the RTSP connection (RTP/AVP/TCP)
+    with the interface of UDPReceiver.
+    """
+    def __init__(self, sock, channel=0, data=b''):
+        """
+        :param sock: RTSP socket, timeout of the socket is used as the receive timeout
+        :param channel: Interleaved channel of RTP packets
+        :param data: Data received after the response to PLAY
+        """
+        self.sock = sock
+        self.demuxer = InterleavedDemuxer(channel)
+        self._pending = self.demuxer.feed(data) if data else []
+
+    def receive(self):
+        """
+        Read the data received in the socket.
+        Packets are memoryviews of the buffer and valid until the next call.
+        :return: [packet, ...]
+        """
+        if self._pending:
+            packets, self._pending = self._pending, []
+            return packets
+        space = self.demuxer.free()
+        size = self.sock.recv_into(space)
+        if not size:
+            raise ConnectionError('RTSP connection closed')
+        self.demuxer.commit(size)
+        return self.demuxer.packets()
+
+    def close(self):
+        pass
+
+
+class JitterBuffer:
+    """
+    Bounded reorder buffer of RTP packets by sequence number.
+    Packets in order pass through without copying, packets ahead of a gap
+    are copied and held until the gap is filled, the buffer is full
+    or the oldest held packet is older than 'latency'.
+    A very large jump of sequence numbers is accepted after two sequential
+    packets (probation of RFC 3550 A.1), a single stray packet is dropped.
+    """
+    def __init__(self, size=256, latency=0.2):
+        """
+        :param size: Maximum held packets
+        :param latency: Maximum time in seconds a packet waits for a gap
+        """
+        self.size = size
+        self.latency = latency
+        self.expected = None
+        self._held = {}  # sequence number: (arrival time, packet)
+        self._arrivals = deque()  # (arrival time, sequence number) of held packets in order of arrival
+        self._probation = None  # (next sequence number, packet) after a very large jump
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.late = 0
+        self.duplicate = 0
+        self.invalid = 0  # Shorter than the RTP header or not RTP version 2
+
+    def stats(self):
+        return {'received': self.received, 'lost': self.lost, 'reordered': self.reordered,
+                'late': self.late, 'duplicate': self.duplicate, 'invalid': self.invalid}
+
+    def _oldest(self):
+        """
+        :return: Arrival time of the oldest held packet
+        """
+        arrivals = self._arrivals
+        while arrivals:
+            arrival, seq = arrivals[0]
+            held = self._held.get(seq)
+            if held is not None and held[0] == arrival:
+                return arrival
+            arrivals.popleft()  # Already passed on
+        return None
+
+    def push(self, packet):
+        """
+        Add RTP packet
+        :param packet: RTP packet
+        :return: [packet, ...] in order of sequence numbers, None in the list marks lost packets
+        """
+        if len(packet) < RTP_HEADER.size or packet[0] >> 6 != 2:
+            self.invalid += 1
+            return []
+        seq = (packet[2] << 8) | packet[3]
+        self.received += 1
+        if self.expected is None:
+            self.expected = seq
+        diff = (seq - self.expected) & 0xFFFF
+        if diff == 0:
+            out = [packet]
+            self.expected = (seq + 1) & 0xFFFF
+            self._probation = None
+            if self._held:
+                self.reordered += 1
+                self._drain(out)
+            return out
+        if diff >= MAX_DROPOUT:
+            if diff >= 0x10000 - MAX_MISORDER:
+                self.late += 1
+                return []
+            probation = self._probation
+            if probation is not None and probation[0] == seq:
+                return self._resync(probation[1], packet, seq)  # I.e. the camera restarted the stream
+            self._probation = ((seq + 1) & 0xFFFF, bytes(packet))
+            return []
+        if seq in self._held:
+            self.duplicate += 1
+            return []
+        now = time.monotonic()
+        self._held[seq] = (now, bytes(packet))
+        self._arrivals.append((now, seq))
+        out = []
+        while self._held and (len(self._held) > self.size or now - self._oldest() > self.latency):
+            self._skip(out)
+        return out
+
+    def _drain(self, out):
+        held = self._held
+        while self.expected in held:
+            out.append(held.pop(self.expected)[1])
+            self.expected = (self.expected + 1) & 0xFFFF
+
+    def _skip(self, out):
+        """
+        Give up waiting the gap, continue from the nearest held packet
+        """
+        gap = min((s - self.expected) & 0xFFFF for s in self._held)
+        self.lost += gap
+        self.expected = (self.expected + gap) & 0xFFFF
+        out.append(None)
+        self._drain(out)
+
+    def _resync(self, first, packet, seq):
+        """
+        Continue from two sequential packets after a very large jump
+        :param first: The packet before 'packet'
+        :param packet: Packet with sequence number 'seq'
+        """
+        out = []
+        while self._held:
+            self._skip(out)
+        self._arrivals.clear()
+        self._probation = None
+        out.append(None)
+        out.append(first)
+        out.append(packet)
+        self.expected = (seq + 1) & 0xFFFF
+        return out
+
+
+class Frame:
+    """
+    Access unit: all NAL units of one picture in Annex B byte stream format
+    """
+    __slots__ = ('data', 'timestamp', 'keyframe', 'time')
+
+    def __init__(self, data, timestamp, keyframe, time):
+        """
+        :param data: Contiguous buffer of NAL units with start codes
+        :param timestamp: RTP timestamp
+        :param keyframe: Frame contains SPS or IDR
+        :param time: Wall-clock time of receipt
+        """
+        self.data = data
+        self.timestamp = timestamp
+        self.keyframe = keyframe
+        self.time = time
+
+
+class AccessUnitAssembler:
+    """
+    Reassembly of NAL units from RTP payloads (single, aggregation and fragmentation
+    units) and grouping them into frames by the marker bit and RTP timestamp.
+    Fragmented NAL units with lost fragments are dropped.
+    """
+    def __init__(self, depacketizer):
+        self.depacketizer = depacketizer
+        self.incomplete = 0  # Dropped NAL units
+        self.parameter_sets = {}  # Last VPS/SPS/PPS without start code
+        self._data = bytearray()
+        self._timestamp = None
+        self._keyframe = False
+        self._fragment = False  # Fragmented NAL unit started at _data[_nal_begin:] is not finished
+        self._nal_begin = 0
+
+    def _emit(self):
+        frame = Frame(self._data, self._timestamp, self._keyframe, time.time())
+        self._data = bytearray()
+        self._keyframe = False
+        return frame
+
+    def _add_units(self, units):
+        depacketizer = self.depacketizer
+        for unit in units:
+            nal = depacketizer.nal_type(unit)
+            typ = depacketizer.parameter_types.get(nal)
+            if typ:
+                self.parameter_sets[typ] = bytes(unit)
+            if nal in depacketizer.keyframe_types:
+                self._keyframe = True
+            self._data += START_CODE
+            self._data += unit
+
+    def feed(self, packets):
+        """
+        Add RTP packets in order of sequence numbers
+        :param packets: [packet, ...], None marks lost packets (see JitterBuffer.push)
+        :return: generator of completed Frame
+        """
+        depacketize = self.depacketizer.depacketize
+        keyframe_types = self.depacketizer.keyframe_types
+        for packet in packets:
+            st = None if packet is None else depacketize(packet)
+            if self._fragment and (st is None or st['typ'] != 'FU' or st['start']):
+                # Lost packets or a new NAL unit before the end of fragmented one
+                del self._data[self._nal_begin:]
+                self._fragment = False
+                self.incomplete += 1
+            if st is None:
+                continue
+            if st['timestamp'] != self._timestamp:
+                if self._data:  # Marker bit of the previous frame is lost
+                    yield self._emit()
+                self._timestamp = st['timestamp']
+            typ = st['typ']
+            if typ == 'FU':
+                if st['start']:
+                    self._fragment = True
+                    self._nal_begin = len(self._data)
+                elif not self._fragment:  # Beginning of the NAL unit is lost
+                    continue
+                if st['end']:
+                    self._fragment = False
+            elif typ == 'AP':
+                self._add_units(st['units'])
+                if st['marker']:
+                    yield self._emit()
+                continue
+            elif typ != 'UNKW':
+                self.parameter_sets[typ] = bytes(st['data'])
+            if st['nal'] in keyframe_types and not self._fragment:  # Fragmented NAL unit is complete
+                self._keyframe = True
+            # Packets are views of the receive pool, copy them into the frame
+            self._data += st['head']
+            self._data += st['data']
+            if st['marker'] and not self._fragment:
+                yield self._emit()
@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 
-import bitstring
+import itertools
 import logging
 import os
 import re
+import select
 import socket
 import sys
 import time
 
-from collections import deque
+from pbuffer import MappedPreBuffer, PreBuffer
+from pmux import MUXERS
+from pwriter import FrameWriter
+from prtp import (AccessUnitAssembler, H264Depacketizer, InterleavedReceiver, JitterBuffer, UDPReceiver,
+                  get_depacketizer)
+from ptrigger import MotionTrigger
+
+RTSP_TIMEOUT = 10  # Seconds to wait a response of the camera
 
 
 class RecordRTSP:
     """
         Recording video from IP-camera.
-        Video file format: 20160101-121134-0.h264
+        Video file format: 20160101-121134-0.h264 (or .h265 for H265 stream)
     """
     def __init__(self, config):
         try:
@@ -27,6 +35,18 @@ class RecordRTSP:
             self.record_buffer = 0
         else:
             self.record_buffer = int(buffer)
+        after = config.get('rec_after_motion')  # Record after the end of motion in seconds
+        self.record_after = float(after) if after else 0
+        self.id_record = 0  # Number of motion record
+        self.motion_events = 0
+        self.merged_events = 0  # Motion events merged with the record of the previous motion
+        pre_buffer_size = config.get('pre_buffer_size')  # Maximum size of pre-record buffer in megabytes
+        if pre_buffer_size:
+            self.pre_buffer_bytes = int(float(pre_buffer_size) * 1024 * 1024)
+        else:  # 1 MB per second (8 Mbit/s)
+            self.pre_buffer_bytes = max(self.record_buffer, 4) * 1024 * 1024
+        # Directory of memory-mapped pre-record buffer files, pre-record is kept in RAM if not set
+        self.pre_buffer_dir = config.get('pre_buffer_dir')
         if config.get('dir_record'):
             self.record_path = os.path.abspath(config.get('dir_record'))
             if not os.path.exists(self.record_path):
@@ -39,28 +59,76 @@ class RecordRTSP:
             self.record_path = os.getcwd()
         self.ip_cam_adress, port = self._get_ip_port(self.rtsp_url)
         self.ip_cam_port = int(port)
+        # 'udp' or 'tcp' - RTP interleaved in the RTSP connection (RTP/AVP/TCP)
+        self.rtsp_transport = config.get('rtsp_transport', 'udp').lower()
+        if self.rtsp_transport not in ('udp', 'tcp'):
+            logging.error("Unknown RTSP transport: {}, use udp".format(self.rtsp_transport))
+            self.rtsp_transport = 'udp'
+        self.rtsp_keepalive = config.get('rtsp_keepalive', 'GET_PARAMETER').upper()  # or OPTIONS
+        delay = config.get('reconnect_delay')  # First delay of reconnect in seconds, doubled on failures
+        self.reconnect_delay = float(delay) if delay else 0.5
+        delay = config.get('reconnect_max_delay')
+        self.reconnect_max_delay = float(delay) if delay else 30
+        self.sdp = None  # Response to DESCRIBE, it is used on reconnect
+        self.id_session = None
+        self.keepalive_interval = 30
+        self._keepalive_at = 0
+        self.ctrl_socket = self.udp_socket = self.udp_receiver = None
+        self.last_frame = None  # Time of the last received frame
+        self._gap_begin = None
+        self.keepalives = 0
+        self.reconnects = 0
+        self.gaps = 0
+        self.gap_ms = 0  # Time without stream because of reconnects
+        self.max_gap_ms = 0
         if config.get('client_ports'):
             self.client_ports = config['client_ports']
         else:
             self.client_ports = [60784, 60785]
+        rcvbuf = config.get('udp_recv_buffer')  # SO_RCVBUF in bytes, for bursts of I-frames
+        self.udp_recv_buffer = int(rcvbuf) if rcvbuf else 0
+        batch = config.get('udp_batch')  # Maximum datagrams per wakeup
+        self.udp_batch = int(batch) if batch else 64
+        jitter = config.get('jitter_buffer')  # Maximum packets held for reordering
+        self.jitter_size = int(jitter) if jitter else 256
+        latency = config.get('jitter_latency')  # Maximum wait of a lost packet in ms
+        self.jitter_latency = int(latency) / 1000 if latency else 0.2
+        write_queue = config.get('write_queue')  # Maximum frames waiting for writing to disk
+        self.write_queue = int(write_queue) if write_queue else 512
+        segment_size = config.get('segment_size')  # Rotation of record files in megabytes
+        self.segment_size = int(float(segment_size) * 1024 * 1024) if segment_size else 0
+        segment_duration = config.get('segment_duration')  # Rotation of record files in seconds
+        self.segment_duration = float(segment_duration) if segment_duration else 0
+        self.writer = None
+        # Sidecar index of key frames for seeking (see pindex)
+        self.keyframe_index = config.get('keyframe_index', 'yes').lower() not in ('no', 'false', '0')
+        self.record_format = config.get('record_format', 'raw')  # 'raw' (.h264, .h265) or 'mp4' (fragmented MP4)
+        if self.record_format not in MUXERS:
+            logging.error("Unknown record format: {}, record as raw".format(self.record_format))
+            self.record_format = 'raw'
         m_describe = ("DESCRIBE {url} RTSP/1.0\r\n"
                       "CSeq: 2\r\n"
                       "User-Agent: python\r\n"
                       "Accept: application/sdp\r\n\r\n").format(url=self.rtsp_url)
-        m_setup = ("SETUP {url} RTSP/1.0\r\n"
-                   "CSeq: 3\r\n"
-                   "User-Agent: python\r\n"
-                   "Transport: RTP/AVP;unicast;client_port={port1}-{port2}\r\n"
-                   "\r\n").format(url=self.rtsp_url, port1=self.client_ports[0], port2=self.client_ports[1])
+        self.m_setup = ("SETUP {url} RTSP/1.0\r\n"
+                        "CSeq: 3\r\n"
+                        "User-Agent: python\r\n"
+                        "Transport: {transport}\r\n"
+                        "\r\n")
         self.m_play = ("PLAY {url} RTSP/1.0\r\n"
                        "CSeq: 5\r\n"
                        "User-Agent: python\r\n"
                        "Session: {id}\r\n"
                        "Range: npt=0.000-\r\n\r\n")
         self.m_close = ("TEARDOWN {url} RTSP/1.0\r\nCSeq: 8\r\nSession: {id}\r\n\r\n")
+        self.m_keepalive = ("{method} {url} RTSP/1.0\r\n"
+                            "CSeq: {cseq}\r\n"
+                            "User-Agent: python\r\n"
+                            "Session: {id}\r\n\r\n")
+        self._cseq = itertools.count(10)
         self.msg_describe = m_describe.encode()
-        self.msg_setup = m_setup.encode()
-        self.format_file = '{}{}.h264'
+        self.msg_setup = self._make_setup_msg(self.client_ports)
+        self._set_depacketizer('H264')
 
     def _get_ip_port(self, url):
         """
@@ -77,106 +145,17 @@ class RecordRTSP:
         :param response: Response from the camera
         :return: ID session
         """
-        resp = response.split('\r\n')
-        for r in resp:
-            ss = r.split()
-            if ss[0].strip() == "Session:":
-                return int(ss[1].split(";")[0].strip())
+        session = re.search(r"Session:\s*([^;\s]+)", response, re.IGNORECASE)
+        if session:
+            return session.group(1)
 
     def _rtp_handler_h264(self, st):
         """
-        This routine takes a UDP packet, i.e. a string of bytes and ..
-            1) strips off the RTP header
-            2) adds NAL "stamps" to the packets, so that they are recognized as NAL's
-            3) Concantenate frames
-            40 Returns a packet that can be written to disk as such and that is recognized
-                by stock media players as h264 stream
+        Depacketization RTP packet of h264 stream (see prtp.H264Depacketizer)
         :param st: RTP packet
-        :return: packet h264 stream
-        """
-        startbytes = b'\x00\x00\x00\x01'  # This is the sequence of four bytes that identifies a NAL packet
-        result = {}
-        bt = bitstring.BitArray(bytes=st)  # Turn the whole string-of-bytes packet into a string of bits
-        lc = 12  # Byte counter
-        bc = 12 * 8  # Bit counter
-        # ******* Parse RTP header ********
-        version = bt[0:2].uint  # Version
-        p = bt[2]  # P
-        x = bt[3]  # X
-        cc = bt[4:8].uint  # CC
-        m = bt[8]  # M
-        pt = bt[9:16].uint  # PT
-        sn = bt[16:32].uint  # sequence number
-        timestamp = bt[32:64].uint  # timestamp
-        ssrc = bt[64:96].uint  # ssrc identifier
-        logging.debug("version:{0}, p: {1}, x: {2}, cc: {3}, m: {4}, pt: {5}".format(version, p, x, cc, m, pt))
-        logging.debug("sequence number: {0}, timestamp: {1}".format(sn, timestamp))
-        logging.debug("sync. source identifier: {}".format(ssrc))
-        if cc:
-            cids = []
-            for i in range(cc):
-                cids.append(bt[bc:bc+32].uint)
-                bc += 32
-                lc += 4
-            logging.debug("csrc identifiers: {}".format(cids))
-        if x:
-            logging.debug('X (additional header) - is True')
-            hid = bt[bc:bc+16].uint
-            bc += 16
-            lc += 2
-            hlen = bt[bc:bc+16].uint
-            bc += 16
-            lc += 2
-            logging.debug("ext. header id: {0}, ext. header len: {1}".format(hid, hlen))
-            bc += 32 * hlen
-            lc += 4 * hlen
-        # ********** NAL packet ************
-        # ********** Parse "First byte" a NAL packet ************
-        fb = bt[bc]  # "F"
-        nri = bt[bc+1:bc+3].uint  # "NRI"
-        nlu0 = bt[bc:bc+3]  # "3 NAL UNIT BITS" (i.e. [F | NRI])
-        typ = bt[bc+3:bc+8].uint  # "Type"
-        logging.debug("F: {0}, NRI: {1}, Type: {2}".format(fb, nri, typ))
-        if 0 <= typ <= 12:
-            if typ == 7:
-                logging.debug("SPS packet")
-                result['typ'] = 'SPS'
-            elif typ == 8:
-                logging.debug("PPS packet")
-                result['typ'] = 'PPS'
-            else:
-                logging.debug("Unknow TYPE packet: {}".format(typ))
-                result['typ'] = 'UNKW'
-            result['data'] = startbytes + st[lc:]
-            return result
-        # ********** Parse "Second byte" a NAL packet ************
-        if typ == 28:  # Handles only "Type" = 28, i.e. "FU-A"
-            bc += 8
-            lc += 1
-            start = bt[bc]  # Start bit
-            end = bt[bc+1]  # End bit
-            nlu1 = bt[bc+3:bc+8]  # 5 nal unit bits
-            logging.debug("Start bit: {}".format(start))
-            logging.debug("End bit: {}".format(end))
-            logging.debug("Reserved bit: {}".format(bt[bc+2]))
-            result['start'] = start  # Start of frame
-            result['end'] = end  # End of the frame
-            head = b''
-            if start:
-                logging.debug(">>> first fragment found")
-                nlu = nlu0 + nlu1  # Create "[3 NAL UNIT BITS | 5 NAL UNIT BITS]"
-                head = startbytes + nlu.bytes  # Add the NAL starting sequence
-                lc += 1
-            elif start is False and end is False:  # Intermediate fragment in a sequence, just dump "VIDEO FRAGMENT DATA"
-                lc += 1  # Skip the "Second byte"
-            elif end:  # Last fragment in a sequence, just dump "VIDEO FRAGMENT DATA"
-                logging.debug(">>> last fragment found")
-                lc += 1  # Skip the "Second byte"
-            result['data'] = head + st[lc:]
-            result['typ'] = 'FU'
-            return result
-        else:
-            logging.error("Unknown frame type ({}) for this fragment".format(typ))
+        :return: {'typ', 'start', 'end', 'head', 'data', ...} - write 'head' and then 'data'
+        """
+        return self.depacketizer.depacketize(st)
 
     def _log_record(self, response):
         """
@@ -204,11 +183,38 @@ class RecordRTSP:
             numas.append(int(num))
         return numas
 
+    def _get_codec(self, response):
+        """
+        Search encoding name of the video stream from SDP ('a=rtpmap' attribute)
+        :param response: Response from the camera to DESCRIBE
+        :return: Encoding name, i.e. 'H264', or None
+        """
+        video = response.find('m=video')
+        if video < 0:
+            video = 0
+        rtpmap = re.search(r"a=rtpmap:\d+ ([\w.-]+)/\d+", response[video:])
+        if rtpmap:
+            return rtpmap.group(1)
+
+    def _set_depacketizer(self, codec):
+        """
+        Select depacketizer and record file extension for codec of the stream
+        :param codec: Encoding name from SDP
+        :return: None
+        """
+        depacketizer = get_depacketizer(codec) if codec else None
+        if depacketizer is None:
+            logging.error("Unsupported codec: {}, record as H264".format(codec))
+            depacketizer = H264Depacketizer()
+        self.depacketizer = depacketizer
+        extension = MUXERS[self.record_format].extension or depacketizer.extension
+        self.format_file = '{}{}.' + extension
+
     def _filename(self, idr=''):
         """
         Creating a record file name
         :param idr: The serial number of the record for integrity monitoring
-        :return: File name in format YYYYYMMDD-HHMMSS-ID.h264
+        :return: File name in format YYYYYMMDD-HHMMSS-ID.h264 (.h265)
         """
         if idr:
             id_rec = '-{}'.format(idr)
@@ -217,84 +223,159 @@ class RecordRTSP:
         filename = self.format_file.format(time.strftime("%Y%m%d-%H%M%S"), id_rec)
         return os.path.join(self.record_path, filename)
 
+    def _segment_names(self, filename='', idr=''):
+        """
+        File names of the next segments of a record on rotation
+        :param filename: File name of the first segment or empty for _filename()
+        :param idr: The serial number of the record
+        :return: generator of file names: YYYYYMMDD-HHMMSS-ID-PART.h264
+        """
+        part = 1
+        while True:
+            if filename:
+                root, ext = os.path.splitext(filename)
+                yield '{}-{}{}'.format(root, part, ext)
+            elif idr:
+                yield self._filename('{}-{}'.format(idr, part))
+            else:
+                yield self._filename(str(part))
+            part += 1
+
     def _get_frame(self):
         """
-        Read a UDP packets and creating of list packages of stream 264
-        Return chunk video between SPS packages.
+        Read a UDP packets and assemble frames of stream h264, send keepalive of the session
+        :return: generator of prtp.Frame
+        """
+        while True:
+            packets = []
+            for resp in self.udp_receiver.receive():
+                packets.extend(self.jitter_buffer.push(resp))
+            for frame in self.assembler.feed(packets):
+                if self._gap_begin is not None:
+                    self._end_gap(frame.time)
+                self.last_frame = frame.time
+                yield frame
+            self._keepalive()
+
+    def _get_chunk(self):
+        """
+        Group frames between key frames.
         Video chunk approximately 2 seconds duration
-        :return: [SPS, PPS, Unknow type, FU-A, FU-A, ...,  FU-A]
+        :return: [Frame(SPS, PPS, IDR), Frame, ...,  Frame]
         """
-        sps_count = 0
         chunk = []
-        while True:
-            resp = self.udp_socket.recv(4096)
-            st = self._rtp_handler_h264(resp)
-            if st['typ'] == 'SPS':
-                sps_count += 1
-                if sps_count == 2:
-                    sps_count -= 1
-                    yield chunk
-                    chunk.clear()
-            chunk.append(st['data'])
-
-    # TODO: rotation by file size
-    def _record_online(self, filename, stop, durations=None):
+        for frame in self._get_frame():
+            if frame.keyframe and chunk:
+                yield chunk
+                chunk = []
+            chunk.append(frame)
+
+    def _get_writer(self):
+        """
+        Writer thread is started in the recording process
+        :return: pwriter.FrameWriter
+        """
+        if self.writer is None:
+            self.writer = FrameWriter(self.write_queue, self.segment_size, self.segment_duration,
+                                      self._make_muxer, self.keyframe_index)
+        return self.writer
+
+    def _make_muxer(self):
+        return MUXERS[self.record_format](self.depacketizer.codec)
+
+    def _stop_writer(self):
+        if self.writer is not None:
+            self.writer.stop()
+            logging.info("Writer: {}".format(self.writer.stats()))
+            self.writer = None
+
+    def _record_online(self, filename, stop, durations=None, segments=None):
         """
         Online record h264 video stream.
+        Files are rotated by 'segment_size' and 'segment_duration'.
         :param filename: str(file name)
         :param stop: multiprocessing.Event() - for stoping video
         :param durations: Durations record
+        :param segments: Iterator of file names of the next segments
         :return: None
         """
-        chunks = self._get_frame()
-        with open(filename, 'wb') as h264:
+        chunks = self._get_chunk()
+        writer = self._get_writer()
+        writer.open(filename, segments or self._segment_names(filename))
+        try:
             begin_rec = time.time()
             for chunk in chunks:
                 for frame in chunk:
-                    h264.write(frame)
+                    writer.write(frame)
                 if stop.is_set():
                     break
                 if durations:
                     if time.time() - begin_rec > durations:
                         break
+        finally:
+            writer.close()
+
+    def _make_pre_buffer(self, size_buffer):
+        """
+        Pre-record buffer in RAM or in memory-mapped file of 'pre_buffer_dir'
+        :param size_buffer: Size buffer per seconds
+        :return: pbuffer.PreBuffer
+        """
+        if self.pre_buffer_dir:
+            path = os.path.abspath(self.pre_buffer_dir)
+            if not os.path.exists(path):
+                try:
+                    os.mkdir(path)
+                except:
+                    logging.error("Fail make dir: {}".format(path))
+                    path = self.record_path
+            name = 'prebuffer-{}-{}.spool'.format(self.ip_cam_adress, self.ip_cam_port)
+            return MappedPreBuffer(self.pre_buffer_bytes, size_buffer, os.path.join(path, name))
+        return PreBuffer(self.pre_buffer_bytes, size_buffer)
 
-    # TODO: rotation by file size
-    def _record_with_pre_buffer(self, size_buffer, start, stop):
+    def _record_with_pre_buffer(self, size_buffer, trigger, stop):
         """
         Record video stream h264 with pre-record buffer.
-        Ring buffer size of 'size_buffer' is constant cyclic flow record.
-        Designed to record video to trigger motion detection.
+        Ring buffer of 'size_buffer' seconds ('pre_buffer_size' megabytes at most)
+        keeps the stream before the start of record, in RAM or in a memory-mapped
+        file of 'pre_buffer_dir'.
+        Designed to record video to trigger motion detection: the trigger is checked
+        on every frame, the record continues 'rec_after_motion' seconds of RTP time
+        after the end of motion (see ptrigger.MotionTrigger).
+        Files are rotated by 'segment_size' and 'segment_duration'.
         :param size_buffer: Size buffer per seconds
-        :param start: multiprocessing.Event() -  start records
+        :param trigger: multiprocessing.Connection - receiving end of the pipe of (motion, time)
         :param stop: multiprocessing.Event() - stop records
         :return: None
         """
-        buffer = deque(maxlen=int(size_buffer/2))
-        chunks = self._get_frame()
+        buffer = self._make_pre_buffer(size_buffer)
+        writer = self._get_writer()
+        motion = MotionTrigger(trigger, self.record_after)
         record = False
-        id_record = 0
-        for chunk in chunks:
-            a = list(chunk)
-            buffer.append(a)
-            if start.is_set() and not record:
-                fn = self._filename(str(id_record))
-                h264 = open(fn, 'wb')
-                record = True
-            if record:
-                e = buffer[0]
-                for f in e:
-                    h264.write(f)
-            if not start.is_set() and record:
-                record = False
-                id_record += 1
-                h264.close()
-                if stop.is_set():
-                    break
-            if stop.is_set():
-                if not start.is_set() and not record:
+        try:
+            for frame in self._get_frame():
+                if frame.keyframe and stop.is_set():
                     break
+                if motion.update(frame):
+                    if not record:
+                        fn = self._filename(str(self.id_record))
+                        writer.open(fn, self._segment_names(idr=str(self.id_record)))
+                        buffer.flush_to(writer)
+                        record = True
+                    writer.write(frame)
                 else:
-                    start.clear()
+                    if record:
+                        record = False
+                        self.id_record += 1
+                        writer.close()
+                    buffer.append(frame)
+        finally:
+            if record:
+                self.id_record += 1
+                writer.close()
+            self.motion_events += motion.events
+            self.merged_events += motion.merged
+            buffer.close()
 
     def _make_send_msg(self, ids, msg):
         """
@@ -306,6 +387,19 @@ class RecordRTSP:
         result = msg.format(url=self.rtsp_url, id=ids)
         return result.encode()
 
+    def _make_setup_msg(self, ports):
+        """
+        Create RTSP SETUP message
+        :param ports: Client ports [RTP, RTCP], not used for interleaved transport
+        :return: RTSP message for send IP camera
+        """
+        if self.rtsp_transport == 'tcp':
+            transport = 'RTP/AVP/TCP;unicast;interleaved=0-1'
+        else:
+            transport = 'RTP/AVP;unicast;client_port={}-{}'.format(ports[0], ports[1])
+        result = self.m_setup.format(url=self.rtsp_url, transport=transport)
+        return result.encode()
+
     def _make_udp_socket(self, ports):
         """
         Create UDP socket for receipt RTP packets
@@ -313,6 +407,11 @@ class RecordRTSP:
         :return: Socket
         """
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.udp_recv_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.udp_recv_buffer)
+            size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            if size < self.udp_recv_buffer:
+                logging.warning("SO_RCVBUF limited by system: {} < {}".format(size, self.udp_recv_buffer))
         for p in ports:
             try:
                 sock.bind(("", p))
@@ -328,83 +427,239 @@ class RecordRTSP:
         :return: Socket
         """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(RTSP_TIMEOUT)
         sock.connect((self.ip_cam_adress, self.ip_cam_port))
         return sock
 
     def _start(self):
         """
-        Start and log control RTSP stream
+        Start and log control RTSP stream.
+        SDP of the first DESCRIBE is used on reconnect, DESCRIBE is repeated if SETUP fails.
         :return:
         """
         self.ctrl_socket = self._make_control_socket()
-        self.ctrl_socket.send(self.msg_describe)
-        self._log_record(self.ctrl_socket.recv(4096).decode())
+        if self.sdp is None:
+            self.ctrl_socket.send(self.msg_describe)
+            resp = self.ctrl_socket.recv(4096).decode()
+            self._log_record(resp)
+            self._set_depacketizer(self._get_codec(resp))
+            self.sdp = resp
         self.ctrl_socket.send(self.msg_setup)
         resp = self.ctrl_socket.recv(4096).decode()
         self._log_record(resp)
+        if self._status(resp) != 200:
+            self.sdp = None  # Stream is changed, DESCRIBE on the next connect
+            raise ConnectionError("SETUP failed: {}".format(resp.split('\r\n', 1)[0]))
+        resp_setup = resp
         id_session = self._id_session(resp)  # Get id session
         self.msg_play = self._make_send_msg(id_session, self.m_play)  # Make PLAY message
         self.msg_close = self._make_send_msg(id_session, self.m_close)  # Make CLOSE message
+        self.id_session = id_session
+        self.keepalive_interval = max(self._session_timeout(resp) / 2, 1)
+        self.jitter_buffer = JitterBuffer(self.jitter_size, self.jitter_latency)
+        self.assembler = AccessUnitAssembler(self.depacketizer)
+        self._keepalive_at = time.monotonic() + self.keepalive_interval
+        if self.rtsp_transport == 'tcp':
+            self.udp_socket = None
+            self.ctrl_socket.send(self.msg_play)
+            resp, data = self._read_play_response()
+            self._log_record(resp)
+            channel = self._get_ports("interleaved", resp_setup)[0] if 'interleaved=' in resp_setup else 0
+            self.ctrl_socket.settimeout(5)
+            self.udp_receiver = InterleavedReceiver(self.ctrl_socket, channel, data)
+            return
         clientports = self._get_ports("client_port", resp)
         self.udp_socket = self._make_udp_socket(clientports)
+        self.udp_receiver = UDPReceiver(self.udp_socket, self.udp_batch)
         self.ctrl_socket.send(self.msg_play)
         self._log_record(self.ctrl_socket.recv(4096).decode())
 
+    def _status(self, response):
+        """
+        Status code of rtsp response
+        :param response: Response from the camera
+        :return: Status code, 0 if it is not a response
+        """
+        status = re.match(r"RTSP/\d\.\d (\d+)", response)
+        return int(status.group(1)) if status else 0
+
+    def _session_timeout(self, response):
+        """
+        Session timeout from the response to SETUP (RFC 2326 12.37)
+        :param response: Response from the camera
+        :return: Timeout in seconds, 60 by default
+        """
+        timeout = re.search(r"Session:[^\r\n]*;\s*timeout=(\d+)", response, re.IGNORECASE)
+        return int(timeout.group(1)) if timeout else 60
+
+    def _make_keepalive_msg(self):
+        """
+        Create keepalive message of the session ('rtsp_keepalive' method)
+        :return: RTSP message for send IP camera
+        """
+        result = self.m_keepalive.format(method=self.rtsp_keepalive, url=self.rtsp_url,
+                                         cseq=next(self._cseq), id=self.id_session)
+        return result.encode()
+
+    def _keepalive(self):
+        """
+        Send keepalive when half of the session timeout is passed.
+        Responses are read here for UDP transport, for interleaved transport
+        they are skipped by the demultiplexer.
+        :return: None
+        """
+        now = time.monotonic()
+        if now < self._keepalive_at:
+            return
+        self._keepalive_at = now + self.keepalive_interval
+        if self.udp_socket is not None:
+            while select.select([self.ctrl_socket], [], [], 0)[0]:
+                resp = self.ctrl_socket.recv(4096)
+                if not resp:
+                    raise ConnectionError('RTSP connection closed')
+                if self._status(resp.decode(errors='replace')) not in (0, 200):
+                    logging.warning("Keepalive response: {}".format(resp.decode(errors='replace').split('\r\n', 1)[0]))
+        self.ctrl_socket.send(self._make_keepalive_msg())
+        self.keepalives += 1
+
+    def _begin_gap(self):
+        """
+        Stream is lost, the gap lasts up to the first frame after reconnect
+        :return: None
+        """
+        self.reconnects += 1
+        if self._gap_begin is None and self.last_frame is not None:
+            self._gap_begin = self.last_frame
+
+    def _end_gap(self, when):
+        """
+        :param when: Time of the first frame after reconnect
+        :return: None
+        """
+        gap = (when - self._gap_begin) * 1000
+        self._gap_begin = None
+        self.gaps += 1
+        self.gap_ms += gap
+        self.max_gap_ms = max(self.max_gap_ms, gap)
+        logging.warning("Stream gap {:.0f} ms, reconnects: {}, lost in total {:.0f} ms"
+                        .format(gap, self.reconnects, self.gap_ms))
+
+    def _connect(self, stop):
+        """
+        Start RTSP session, retry with exponential backoff
+        from 'reconnect_delay' up to 'reconnect_max_delay' seconds
+        :param stop: multiprocessing.Event() - stop retries
+        :return: True if the session is started
+        """
+        delay = 0
+        while not stop.is_set():
+            try:
+                self._start()
+                return True
+            except (OSError, ValueError, IndexError, TypeError) as error:
+                logging.error("RTSP connect failed: {}".format(error))
+                self._close_sockets()
+            delay = min(delay * 2 or self.reconnect_delay, self.reconnect_max_delay)
+            stop.wait(delay)
+        return False
+
+    def _read_play_response(self):
+        """
+        Read response to PLAY up to the interleaved data
+        :return: (response, data after the response)
+        """
+        data = b''
+        while b'\r\n\r\n' not in data:
+            part = self.ctrl_socket.recv(4096)
+            if not part:
+                raise ConnectionError('RTSP connection closed')
+            data += part
+        head, data = data.split(b'\r\n\r\n', 1)
+        return head.decode(errors='replace'), data
+
     def _finish(self):
         """
         Close connection
         :return:
         """
-        self.ctrl_socket.send(self.msg_close)
-        self._log_record(self.ctrl_socket.recv(4096).decode())
-        self.ctrl_socket.close()
-        self.udp_socket.close()
+        try:
+            self.ctrl_socket.send(self.msg_close)
+            if self.udp_socket is not None:  # Response is not read after the interleaved data
+                self._log_record(self.ctrl_socket.recv(4096).decode(errors='replace'))
+        except OSError as error:
+            logging.warning("TEARDOWN failed: {}".format(error))
+        logging.info("RTP stream: {}".format(self._stream_stats()))
+        self._close_sockets()
+
+    def _close_sockets(self):
+        for sock in (self.ctrl_socket, self.udp_socket):
+            if sock is not None:
+                sock.close()
+        if self.udp_receiver is not None:
+            self.udp_receiver.close()
+        self.ctrl_socket = self.udp_socket = self.udp_receiver = None
+
+    def _stream_stats(self):
+        """
+        Statistics of the received stream and of the writer
+        :return: dict
+        """
+        stats = self.jitter_buffer.stats()
+        stats['incomplete_nal'] = self.assembler.incomplete
+        if self.motion_events:
+            stats.update({'motion_events': self.motion_events, 'merged_events': self.merged_events})
+        stats.update({'keepalives': self.keepalives, 'reconnects': self.reconnects, 'gaps': self.gaps,
+                      'gap_ms': round(self.gap_ms), 'max_gap_ms': round(self.max_gap_ms)})
+        if self.writer is not None:
+            stats.update({'writer_' + k: v for k, v in self.writer.stats().items()})
+        return stats
 
     def run_record_online(self, stop, durations=None, filename=None):
         """
-        Run recording online video
+        Run recording online video, the record continues in the next segment after reconnect
         :param stop: multiprocessing.Event() - stop online record
         :param durations: Duration record in seconds
         :param filename:
         :return:
         """
-        stop_event = stop
-        self._start()
-        if filename:
-            file_name = filename
-        else:
-            file_name = self._filename()
-        while True:
+        file_name = filename
+        segments = self._segment_names(filename)
+        begin_rec = time.time()
+        while self._connect(stop):
             try:
-                self._record_online(file_name, stop_event, durations)
-            except socket.timeout as time_error:
-                logging.error("_record_with_pre_buffer() - Exception socket: {}".format(time_error))
-                continue
+                if not file_name:  # Extension of the codec is known after DESCRIBE
+                    file_name = self._filename()
+                rest = durations - (time.time() - begin_rec) if durations else None
+                self._record_online(file_name, stop, rest, segments)
+                break
+            except (OSError, ValueError) as error:  # socket.timeout, connection closed
+                logging.error("_record_online() - Exception socket: {}".format(error))
+                self._begin_gap()
+                file_name = next(segments)
             except KeyboardInterrupt:
-                pass
+                break
             except:
                 logging.error("_record_online() - ERROR: {}".format(sys.exc_info()[0]))
                 break
             finally:
                 self._finish()
+        self._stop_writer()
 
-    def run_record_with_prebuffer(self, start, stop):
+    def run_record_with_prebuffer(self, trigger, stop):
         """
         Run record video with pre-recording
-        :param size_buffer: Duration pre-recording in second
-        :param start: multiprocessing.Event() - start online record
+        :param trigger: multiprocessing.Connection - receiving end of the pipe of (motion, time),
+        motion detector sends the message on every change of motion
         :param stop: multiprocessing.Event() - stop online record
         :return:
         """
-        while True:
-            self._start()
-            strt = start
-            stp = stop
+        while self._connect(stop):
             try:
-                self._record_with_pre_buffer(self.record_buffer, strt, stp)
-            except socket.timeout as time_error:
-                logging.error("_record_with_pre_buffer() - Exception socket: {}".format(time_error))
-                continue
+                self._record_with_pre_buffer(self.record_buffer, trigger, stop)
+                break
+            except (OSError, ValueError) as error:  # socket.timeout, connection closed
+                logging.error("_record_with_pre_buffer() - Exception socket: {}".format(error))
+                self._begin_gap()
             except KeyboardInterrupt:
                 break
             except:
@@ -412,3 +667,4 @@ class RecordRTSP:
                 break
             finally:
                 self._finish()
+        self._stop_writer()
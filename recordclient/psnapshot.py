@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from hashlib import sha1
+
+
+class SnapshotPipeline:
+    """
+    Snapshots are fetched from the camera, written to files and uploaded on separate threads,
+    so the motion loop only passes states of motion and never waits for the camera, the disk or the Drive.
+    The stages are linked by queues, the queues of snapshots are bounded:
+        write - the oldest snapshot is dropped when the queue is full
+        upload - the oldest file is not uploaded (it stays on disk) when the queue is full
+    Snapshots of a motion event (see motion()) are taken by the policy: the first one at once,
+    then one every interval, the largest JPEG (the most detailed) of best_of snapshots
+    taken in the interval. Snapshots equal to one of the event are not stored.
+    Files of an event are grouped: <directory>/<event>/<event>-<number>.jpg,
+    the event is the date and time of its beginning with milliseconds.
+    """
+    _STOP = None
+
+    def __init__(self, cam, directory, drive=None, clean=False, max_queue=16, interval=5, best_of=1, max_event=0):
+        """
+        :param cam: OnvifCam
+        :param directory: Directory of snapshots
+        :param drive: GoogleDrive or None - without upload
+        :param clean: Remove files after upload
+        :param max_queue: Maximum snapshots waiting for writing and files waiting for upload
+        :param interval: Seconds between snapshots of a motion event, 0 - only the first snapshot
+        :param best_of: Snapshots taken for one snapshot of the interval
+        :param max_event: Maximum snapshots of a motion event, 0 - unlimited
+        """
+        self.cam = cam
+        self.directory = os.path.abspath(directory)
+        self.drive = drive
+        self.clean = clean
+        self.max_queue = max_queue
+        self.interval = interval
+        self.best_of = max(best_of, 1)
+        self.max_event = max_event
+        self._fetch = queue.Queue()  # States of motion
+        self._write = queue.Queue()
+        self._upload = queue.Queue()
+        self._event = None  # Current motion event
+        self._last = None  # Last finished motion event, continued when its name is reused
+        self.events = 0
+        self.duplicates = 0  # Snapshots equal to one of the event
+        self.fetched = 0
+        self.failed = 0  # Fetch, write or upload errors
+        self.written = 0
+        self.uploaded = 0
+        self.dropped = 0  # Snapshots or files dropped because of full queues
+        self._threads = []
+        for target, name in ((self._run_fetch, 'fetch'), (self._run_write, 'write'), (self._run_upload, 'upload')):
+            thread = threading.Thread(target=target, name='snapshot {}'.format(name))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stats(self):
+        return {'events': self.events, 'fetched': self.fetched, 'duplicates': self.duplicates, 'written': self.written,
+                'uploaded': self.uploaded, 'dropped': self.dropped, 'failed': self.failed,
+                'depth': (self._fetch.qsize(), self._write.qsize(), self._upload.qsize())}
+
+    def motion(self, state):
+        """
+        State of motion without blocking, snapshots of motion events are taken by the policy
+        :param state: True - motion, False - no motion
+        :return: None
+        """
+        self._fetch.put_nowait(bool(state))
+
+    def _put_dropping_oldest(self, stage, item):
+        while stage.qsize() >= self.max_queue:
+            try:
+                old = stage.get_nowait()
+            except queue.Empty:
+                break
+            self.dropped += 1
+            logging.warning("Snapshot queue is full ({}), dropped: {}".format(
+                self.max_queue, old[2] if stage is self._upload else time.ctime(old[1])))
+        stage.put_nowait(item)
+
+    def stop(self):
+        """
+        Finish the queued snapshots and stop the threads
+        :return: None
+        """
+        self._fetch.put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run_fetch(self):
+        while True:
+            timeout = None
+            if self._event is not None and self._event['next'] is not None:
+                timeout = max(self._event['next'] - time.time(), 0)
+            try:
+                item = self._fetch.get(timeout=timeout)
+            except queue.Empty:
+                self._take_candidate()
+                continue
+            if item is self._STOP:
+                self._end_event()
+                self._write.put(self._STOP)
+                return
+            if item:
+                if self._event is None:
+                    self._begin_event()
+            else:
+                self._end_event()
+
+    def _get_snapshot(self):
+        content = self.cam.get_snapshot()
+        if not content:
+            self.failed += 1
+            return None
+        self.fetched += 1
+        return content
+
+    def _begin_event(self):
+        now = time.time()
+        self.events += 1
+        name = '{}-{:03d}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now * 1000) % 1000)
+        if self._last is not None and self._last['name'] == name:
+            # Files of the reused name are numbered after the files of the last event
+            self._event = dict(self._last, candidates=[], next=None)
+        else:
+            self._event = {'name': name, 'number': 0, 'hashes': set(), 'candidates': [], 'next': None}
+        content = self._get_snapshot()
+        if content:
+            self._emit(content, now)
+        self._schedule(now)
+
+    def _schedule(self, now):
+        event = self._event
+        if not self.interval or (self.max_event and event['number'] >= self.max_event):
+            event['next'] = None
+        else:
+            event['next'] = now + self.interval / self.best_of
+
+    def _take_candidate(self):
+        """
+        One of best_of snapshots of the interval, the largest of them is stored
+        """
+        now = time.time()
+        content = self._get_snapshot()
+        if content:
+            self._event['candidates'].append((len(content), now, content))
+        if len(self._event['candidates']) >= self.best_of:
+            self._emit_best()
+        self._schedule(now)
+
+    def _emit_best(self):
+        candidates = self._event['candidates']
+        if candidates:
+            size, taken, content = max(candidates, key=lambda i: i[0])
+            self._emit(content, taken)
+        candidates.clear()
+
+    def _end_event(self):
+        if self._event is None:
+            return
+        self._emit_best()  # The best of the last interval
+        logging.info("Motion event {}: snapshots: {}".format(self._event['name'], self._event['number']))
+        self._last = self._event
+        self._event = None
+
+    def _emit(self, content, taken):
+        """
+        Pass the snapshot to writing, snapshots equal to one of the event are skipped
+        :param content: JPEG
+        :param taken: Time of the snapshot
+        """
+        event = self._event
+        digest = sha1(content).digest()
+        if digest in event['hashes']:
+            self.duplicates += 1
+            return
+        if self.max_event and event['number'] >= self.max_event:
+            return
+        event['hashes'].add(digest)
+        event['number'] += 1
+        self._put_dropping_oldest(self._write, (content, taken, (event['name'], event['number'])))
+
+    def _file_name(self, group):
+        """
+        :param group: (event, number)
+        :return: Absolute file name
+        """
+        event, number = group
+        return os.path.join(self.directory, event, '{}-{:03d}.jpg'.format(event, number))
+
+    def _run_write(self):
+        while True:
+            item = self._write.get()
+            if item is self._STOP:
+                self._upload.put(self._STOP)
+                return
+            content, taken, group = item
+            file = self._file_name(group)
+            try:
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+                with open(file, 'wb') as f:
+                    f.write(content)
+            except OSError as error:
+                logging.error("Fail write snapshot {}: {}".format(file, error))
+                self.failed += 1
+                continue
+            self.written += 1
+            if self.drive is not None:
+                self._put_dropping_oldest(self._upload, (taken, group, file))
+
+    def _run_upload(self):
+        while True:
+            item = self._upload.get()
+            if item is self._STOP:
+                return
+            file = item[2]
+            if not self.drive.upload(file):
+                logging.error("Fail upload snapshot {}".format(file))
+                self.failed += 1
+                continue
+            self.uploaded += 1
+            if self.clean:
+                try:
+                    os.remove(file)
+                except OSError as error:
+                    logging.warning("Fail remove snapshot {}: {}".format(file, error))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import os
+import time
+from multiprocessing import Pipe, Process
+
+from pasync import MultiRecorder
+
+
+def run_worker(connection, stop, interval=5):
+    """
+    Worker process: records cameras in one event loop (see pasync.MultiRecorder).
+    Commands ('add', name, config) and ('remove', name, None) are received
+    from the pipe, ('stats', {name: {'rate', 'packets', 'reconnects'}}) is sent
+    every 'interval' seconds.
+    :param connection: multiprocessing.Connection - pipe to the supervisor
+    :param stop: multiprocessing.Event() - stop record
+    :param interval: Seconds between reports
+    :return: None
+    """
+    try:
+        asyncio.run(_worker(connection, stop, interval))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker(connection, stop, interval):
+    loop = asyncio.get_running_loop()
+    recorder = MultiRecorder()
+
+    def receive():
+        try:
+            while connection.poll():
+                command, name, config = connection.recv()
+                if command == 'add':
+                    recorder.add(name, config)
+                elif command == 'remove':
+                    recorder.remove(name)
+        except (EOFError, OSError):  # The supervisor is gone
+            loop.remove_reader(connection.fileno())
+            recorder.stop()
+
+    loop.add_reader(connection.fileno(), receive)
+    report = loop.create_task(_report(connection, recorder, interval))
+    try:
+        await recorder.run(stop)
+    finally:
+        report.cancel()
+
+
+async def _report(connection, recorder, interval):
+    last = {}  # name: (camera, packets at the previous report)
+    while True:
+        await asyncio.sleep(interval)
+        stats = {}
+        for name, camera in recorder.cameras.items():
+            previous, packets = last.get(name, (None, 0))
+            if previous is not camera:  # The camera is added again
+                packets = 0
+            stats[name] = {'rate': (camera.packets - packets) / interval, 'packets': camera.packets,
+                           'reconnects': camera.reconnects}
+            last[name] = (camera, camera.packets)
+        try:
+            connection.send(('stats', stats))
+        except OSError:
+            recorder.stop()
+            return
+
+
+class Supervisor:
+    """
+    Record of many cameras on all cores.
+    Cameras are sharded across worker processes (one per core by default),
+    every worker records its cameras in one event loop. The supervisor restarts
+    workers that exit or stop reporting, and moves a camera from the worker
+    with the highest packet rate to the least loaded one.
+    """
+    def __init__(self, cameras, workers=None, interval=5, tolerance=0.25, cooldown=60):
+        """
+        :param cameras: {name: settings of RecordRTSP with 'rtsp_url'}
+        :param workers: Number of worker processes, number of cores by default
+        :param interval: Seconds between reports of workers
+        :param tolerance: Overload of worker over the mean packet rate before rebalance, 0.25 - 25 %
+        :param cooldown: Minimum seconds between moves of cameras
+        """
+        self.cameras = cameras
+        self.workers = max(min(workers or os.cpu_count() or 1, len(cameras)), 1)
+        self.interval = interval
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.assignment = {}  # name: number of worker
+        self.rates = {}  # name: RTP packets per second
+        self.restarts = 0
+        self.moves = 0
+        self._processes = [None] * self.workers
+        self._connections = [None] * self.workers
+        self._reported = [0] * self.workers  # Time of the last report of worker
+        self._moved = 0  # Time of the last move
+        self._stop = None
+
+    def _shard(self):
+        """
+        Assign cameras to workers, cameras with the highest rate first to the least loaded worker
+        :return: None
+        """
+        loads = [0] * self.workers
+        for name in sorted(self.cameras, key=lambda n: self.rates.get(n, 0), reverse=True):
+            number = loads.index(min(loads))
+            self.assignment[name] = number
+            loads[number] += self.rates.get(name, 0) or 1
+
+    def shard(self, number):
+        """
+        :param number: Number of worker
+        :return: Names of cameras of worker
+        """
+        return [name for name, worker in self.assignment.items() if worker == number]
+
+    def loads(self):
+        """
+        :return: [RTP packets per second of worker, ...]
+        """
+        loads = [0] * self.workers
+        for name, number in self.assignment.items():
+            loads[number] += self.rates.get(name, 0)
+        return loads
+
+    def _send(self, number, command, name, config=None):
+        try:
+            self._connections[number].send((command, name, config))
+        except OSError as error:  # The worker is restarted with all its cameras
+            logging.error("Worker {}: {}".format(number, error))
+
+    def _start_worker(self, number):
+        connection, child = Pipe()
+        process = Process(target=run_worker, args=(child, self._stop, self.interval),
+                          name='recordworker-{}'.format(number))
+        process.daemon = True
+        process.start()
+        child.close()
+        self._processes[number] = process
+        self._connections[number] = connection
+        self._reported[number] = time.monotonic()
+        for name in self.shard(number):
+            self._send(number, 'add', name, self.cameras[name])
+        logging.info("Worker {} (pid {}): {}".format(number, process.pid, self.shard(number)))
+
+    def _check_worker(self, number):
+        """
+        Take reports of worker, restart it if it is dead or hung
+        :param number: Number of worker
+        :return: None
+        """
+        process = self._processes[number]
+        connection = self._connections[number]
+        try:
+            while connection.poll():
+                _, stats = connection.recv()
+                self._reported[number] = time.monotonic()
+                for name, camera in stats.items():
+                    if self.assignment.get(name) == number:
+                        self.rates[name] = camera['rate']
+        except (EOFError, OSError):
+            pass
+        hung = time.monotonic() - self._reported[number] > 3 * self.interval
+        if process.is_alive() and not hung:
+            return
+        if hung and process.is_alive():
+            logging.error("Worker {} does not report, restart".format(number))
+            process.terminate()
+            process.join(1)
+        else:
+            logging.error("Worker {} exited with code {}, restart".format(number, process.exitcode))
+        connection.close()
+        self.restarts += 1
+        self._start_worker(number)
+
+    def _rebalance(self):
+        """
+        Move one camera from the overloaded worker to the least loaded worker
+        :return: None
+        """
+        if time.monotonic() - self._moved < self.cooldown:
+            return
+        loads = self.loads()
+        busiest = loads.index(max(loads))
+        idlest = loads.index(min(loads))
+        mean = sum(loads) / len(loads)
+        if not mean or loads[busiest] <= mean * (1 + self.tolerance):
+            return
+        difference = loads[busiest] - loads[idlest]
+        # The idlest worker must stay clearly below the busiest one, otherwise the camera goes back and forth
+        limit = loads[busiest] * (1 - self.tolerance) - loads[idlest]
+        candidates = [n for n in self.shard(busiest) if self.rates.get(n, 0) < limit]
+        if len(self.shard(busiest)) < 2 or not candidates:
+            return
+        name = min(candidates, key=lambda n: abs(difference / 2 - self.rates.get(n, 0)))
+        logging.warning("Worker {} is overloaded ({:.0f} packets/s, mean {:.0f}), move {} to worker {}"
+                        .format(busiest, loads[busiest], mean, name, idlest))
+        self._send(busiest, 'remove', name)
+        self.assignment[name] = idlest
+        self._send(idlest, 'add', name, self.cameras[name])
+        self.moves += 1
+        self._moved = time.monotonic()
+
+    def stats(self):
+        return {'workers': self.workers, 'loads': self.loads(), 'restarts': self.restarts, 'moves': self.moves}
+
+    def run(self, stop):
+        """
+        Run workers until 'stop' is set
+        :param stop: multiprocessing.Event() - stop record
+        :return: None
+        """
+        self._stop = stop
+        self._shard()
+        self._moved = time.monotonic()  # Rates are known after the first reports
+        for number in range(self.workers):
+            self._start_worker(number)
+        try:
+            while not stop.wait(self.interval):
+                for number in range(self.workers):
+                    self._check_worker(number)
+                self._rebalance()
+        finally:
+            stop.set()
+            for process in self._processes:
+                process.join(10)
+                if process.is_alive():
+                    process.terminate()
+            logging.info("Supervisor: {}".format(self.stats()))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+
+class MotionTrigger:
+    """
+    Record state from timestamped motion messages.
+    The detector sends (motion, time) to the pipe on every change of motion,
+    the recorder checks the pipe on every frame, so the record starts on the frame
+    after the message. The post-record is counted in RTP time of the frames
+    from the time of the end of motion. Motion that begins again before the end
+    of post-record continues the same record (overlapping events are merged).
+    """
+    def __init__(self, connection, post_seconds, clock_rate=90000):
+        """
+        :param connection: multiprocessing.Connection - receiving end of the pipe of (motion, time)
+        :param post_seconds: Duration of record after the end of motion
+        :param clock_rate: RTP clock rate of the stream
+        """
+        self.connection = connection
+        self.clock_rate = clock_rate
+        self.post_duration = int(post_seconds * clock_rate)
+        self.motion = False
+        self._stop_at = None  # RTP timestamp of the end of post-record
+        self.events = 0  # Motion events
+        self.merged = 0  # Motion events merged with the previous record
+
+    def _receive(self, frame):
+        while self.connection.poll():
+            motion, when = self.connection.recv()
+            if motion and not self.motion:
+                self.events += 1
+                if self._stop_at is not None:
+                    self.merged += 1
+                self._stop_at = None
+            elif not motion and self.motion:
+                rest = self.post_duration - int((frame.time - when) * self.clock_rate)
+                self._stop_at = (frame.timestamp + max(rest, 0)) & 0xFFFFFFFF
+            self.motion = motion
+
+    def update(self, frame):
+        """
+        Take the messages received before the frame
+        :param frame: prtp.Frame
+        :return: True if the frame is recorded
+        """
+        self._receive(frame)
+        if self.motion:
+            return True
+        if self._stop_at is None:
+            return False
+        if (frame.timestamp - self._stop_at) & 0xFFFFFFFF < 0x80000000:  # End of post-record is reached
+            self._stop_at = None
+            return False
+        return True
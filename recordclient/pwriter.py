@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import queue
+import threading
+
+from pindex import INDEX_ENTRY, INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION, index_path
+from pmux import AnnexB
+from prtp import Frame
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def write_buffers(fd, buffers):
+    """
+    Write list of buffers to file descriptor with the minimum of system calls
+    :param fd: File descriptor
+    :param buffers: [bytes-like, ...]
+    :return: Written bytes
+    """
+    total = 0
+    if not hasattr(os, 'writev'):
+        data = b''.join(buffers)
+        view = memoryview(data)
+        while total < len(data):
+            total += os.write(fd, view[total:])
+        return total
+    for i in range(0, len(buffers), IOV_MAX):
+        part = buffers[i:i + IOV_MAX]
+        size = sum(len(b) for b in part)
+        written = os.writev(fd, part)
+        if written < size:  # Partial write, write the rest as one buffer
+            rest = memoryview(b''.join(part))[written:]
+            while len(rest):
+                rest = rest[os.write(fd, rest):]
+        total += size
+    return total
+
+
+def copy_range(src, dst, offset, size):
+    """
+    Copy bytes between files in the kernel where possible
+    :param src: Source file descriptor
+    :param dst: Destination file descriptor, bytes are written at its position
+    :param offset: Offset in the source file
+    :param size: Number of bytes
+    :return: None
+    """
+    while size > 0:
+        try:
+            if hasattr(os, 'copy_file_range'):
+                copied = os.copy_file_range(src, dst, size, offset)
+            elif hasattr(os, 'sendfile'):
+                copied = os.sendfile(dst, src, offset, size)
+            else:
+                raise OSError('no copy in kernel')
+        except OSError:
+            os.lseek(src, offset, os.SEEK_SET)
+            copied = os.write(dst, os.read(src, min(size, 1 << 20)))
+        if not copied:
+            break
+        offset += copied
+        size -= copied
+
+
+class FrameWriter:
+    """
+    Writing frames to files on a separate thread.
+    Frames are passed through a bounded queue and written by chunks with os.writev,
+    so a slow disk does not stall receiving of the stream.
+    When the queue is full frames are dropped up to the next key frame.
+    Files are rotated at key frames by size and duration.
+    Byte offsets of key frames are written to the sidecar index (see pindex).
+    """
+    _OPEN = 'open'
+    _CLOSE = 'close'
+    _STOP = 'stop'
+    _SPOOL = 'spool'
+
+    def __init__(self, max_queue=512, max_size=0, max_duration=0, muxer=AnnexB, index=True):
+        """
+        :param max_queue: Maximum frames waiting for writing
+        :param max_size: Maximum size of file in bytes, 0 - without rotation by size
+        :param max_duration: Maximum duration of file in seconds, 0 - without rotation by duration
+        :param muxer: Factory of the file format, called for every file (see pmux)
+        :param index: Write key frame index
+        """
+        self.max_queue = max_queue
+        self.muxer = muxer
+        self.index = index
+        self.max_size = max_size
+        self.max_duration = max_duration
+        self._segments = None
+        self._size = 0  # Size of the current file
+        self._begin = None  # Time of the first frame of the current file
+        self._queue = queue.Queue()  # Bounded for frames in write(), commands are never blocked
+        self._dropping = False
+        self._wait_keyframe = False  # The file has no key frame yet
+        self.dropped = 0  # Dropped frames because of back-pressure
+        self.written = 0  # Written bytes
+        self.high_water = 0  # Maximum depth of the queue
+        self._thread = threading.Thread(target=self._run, name='FrameWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def depth(self):
+        """
+        :return: Frames waiting for writing
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        return {'depth': self.depth(), 'high_water': self.high_water,
+                'dropped': self.dropped, 'written': self.written}
+
+    def open(self, filename, segments=None):
+        """
+        Begin a new file, the previous file is closed
+        :param filename: File name
+        :param segments: Iterator of file names of the next segments for rotation
+        :return: None
+        """
+        self._segments = segments
+        self._size = 0
+        self._begin = None
+        self._wait_keyframe = True
+        self._queue.put((self._OPEN, filename))
+
+    def close(self):
+        """
+        Close the current file after all queued frames are written
+        :return: None
+        """
+        self._segments = None
+        self._queue.put((self._CLOSE, None))
+
+    def _need_rotate(self, frame):
+        if self.max_size and self._size >= self.max_size:
+            return True
+        if self.max_duration and self._begin is not None and frame.time - self._begin >= self.max_duration:
+            return True
+        return False
+
+    def write(self, frame):
+        """
+        Queue frame for writing without blocking
+        :param frame: prtp.Frame
+        :return: False if frame dropped
+        """
+        if self._wait_keyframe:  # Frames before the first key frame of file are not decodable
+            if not frame.keyframe:
+                return False
+            self._wait_keyframe = False
+        if frame.keyframe and self._segments is not None and self._need_rotate(frame):
+            self._size = 0
+            self._begin = None
+            self._queue.put((self._OPEN, next(self._segments)))
+        if self._dropping:
+            if not frame.keyframe:
+                self.dropped += 1
+                return False
+        depth = self._queue.qsize()
+        if depth >= self.max_queue:
+            if not self._dropping:
+                logging.warning("Writer queue is full ({} frames), dropping frames up to the key frame"
+                                .format(self.max_queue))
+            self._dropping = True
+            self.dropped += 1
+            return False
+        self._queue.put_nowait(frame)
+        self._size += len(frame.data)
+        if self._begin is None:
+            self._begin = frame.time
+        if self._dropping:
+            self._dropping = False
+            logging.warning("Writer resumed, dropped frames: {}".format(self.dropped))
+        if depth >= self.high_water:
+            self.high_water = depth + 1
+        return True
+
+    def write_frames(self, frames):
+        """
+        Queue frames (i.e. the pre-record buffer) for writing by one item of the queue
+        :param frames: [prtp.Frame, ...]
+        :return: None
+        """
+        if not frames:
+            return
+        self._wait_keyframe = False
+        self._queue.put_nowait(frames)
+        self._size += sum(len(f.data) for f in frames)
+        if self._begin is None:
+            self._begin = frames[0].time
+
+    def write_spool(self, path, frames):
+        """
+        Queue frames of the detached pre-record file for writing to the current file
+        :param path: Detached pre-record file, it is removed after writing
+        :param frames: [(offset, size, timestamp, keyframe, time), ...]
+        :return: None
+        """
+        if not frames:
+            os.remove(path)
+            return
+        self._wait_keyframe = False
+        self._queue.put_nowait((self._SPOOL, (path, frames)))
+        self._size += sum(f[1] for f in frames)
+        if self._begin is None:
+            self._begin = frames[0][4]
+
+    def stop(self):
+        """
+        Write all queued frames and stop the thread
+        :return: None
+        """
+        self._queue.put((self._STOP, None))
+        self._thread.join()
+
+    def _run(self):
+        self._fd = None
+        self._mux = None
+        self._index = None
+        self._position = 0  # Offset in the current file
+        self._buffers = []
+        while True:
+            item = self._queue.get()
+            while True:
+                if isinstance(item, tuple):
+                    command, argument = item
+                    if command == self._SPOOL:
+                        self._write_spool(*argument)
+                    else:
+                        self._close_file()
+                        if command == self._STOP:
+                            return
+                        if command == self._OPEN:
+                            self._open_file(argument)
+                elif self._fd is not None:
+                    for frame in item if isinstance(item, list) else (item,):
+                        self._add(frame)
+                try:  # Take all frames already queued
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._flush()
+            if self._index is not None:
+                self._index.flush()
+
+    def _open_file(self, filename):
+        try:
+            self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+            self._mux = self.muxer()
+            self._position = 0
+            if self.index:
+                self._index = open(index_path(filename), 'wb')
+                self._index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION))
+        except OSError as error:
+            logging.error("Fail open file {}: {}".format(filename, error))
+
+    def _close_file(self):
+        if self._mux is not None:
+            self._buffers.extend(self._mux.finish())
+            self._mux = None
+        self._flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _add(self, frame):
+        try:
+            out = self._mux.add(frame)
+        except Exception as error:
+            logging.error("Fail mux frame: {}".format(error))
+            out = []
+        size = sum(len(b) for b in out)
+        if self._index is not None and frame.keyframe and (out or not self._mux.buffered):
+            offset = self._position + size if self._mux.buffered else self._position
+            self._index.write(INDEX_ENTRY.pack(offset, frame.timestamp, frame.time))
+        self._position += size
+        self._buffers.extend(out)
+        if len(self._buffers) >= IOV_MAX:
+            self._flush()
+
+    def _write_spool(self, path, frames):
+        """
+        Write frames of the detached pre-record file (see pbuffer.MappedPreBuffer).
+        Raw stream is copied by ranges in the kernel, other formats are muxed frame by frame.
+        :param path: Detached pre-record file, it is removed after writing
+        :param frames: [(offset, size, timestamp, keyframe, time), ...]
+        """
+        try:
+            if self._fd is None:
+                return
+            with open(path, 'rb') as spool:
+                if self._mux.buffered:
+                    for offset, size, timestamp, keyframe, time in frames:
+                        spool.seek(offset)
+                        self._add(Frame(spool.read(size), timestamp, keyframe, time))
+                    return
+                self._flush()
+                runs = []  # Contiguous ranges of the file
+                for offset, size, timestamp, keyframe, time in frames:
+                    if keyframe and self._index is not None:
+                        self._index.write(INDEX_ENTRY.pack(self._position, timestamp, time))
+                    self._position += size
+                    if runs and runs[-1][0] + runs[-1][1] == offset:
+                        runs[-1][1] += size
+                    else:
+                        runs.append([offset, size])
+                for offset, size in runs:
+                    copy_range(spool.fileno(), self._fd, offset, size)
+                    self.written += size
+        except OSError as error:
+            logging.error("Fail write pre-record buffer: {}".format(error))
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _flush(self):
+        if not self._buffers:
+            return
+        try:
+            self.written += write_buffers(self._fd, self._buffers)
+        except OSError as error:
+            logging.error("Fail write file: {}".format(error))
+        self._buffers = []
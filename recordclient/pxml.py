@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import xml.etree.ElementTree as ET
+
+
+SOAP_ENV = 'http://www.w3.org/2003/05/soap-envelope'
+TDS = 'http://www.onvif.org/ver10/device/wsdl'
+TRT = 'http://www.onvif.org/ver10/media/wsdl'
+TT = 'http://www.onvif.org/ver10/schema'
+TEV = 'http://www.onvif.org/ver10/events/wsdl'
+TAN = 'http://www.onvif.org/ver20/analytics/wsdl'
+WSA = 'http://www.w3.org/2005/08/addressing'
+WSNT = 'http://docs.oasis-open.org/wsn/b-2'
+
+# Elements read from the responses (Clark notation {namespace}name)
+FAULT_TEXT = '{%s}Text' % SOAP_ENV
+FAULT_CODE = '{%s}Code' % SOAP_ENV
+FAULT_VALUE = '{%s}Value' % SOAP_ENV
+FAULT_DETAIL = '{%s}Detail' % SOAP_ENV
+CAPABILITIES = '{%s}Capabilities' % TDS
+DEVICE_INFORMATION = '{%s}GetDeviceInformationResponse' % TDS
+SYSTEM_DATE_TIME = '{%s}SystemDateAndTime' % TDS
+PROFILES = '{%s}Profiles' % TRT
+PROFILE = '{%s}Profile' % TRT
+VIDEO_SOURCES = '{%s}VideoSources' % TRT
+NAME = '{%s}Name' % TT
+URI = '{%s}Uri' % TT
+DATA = '{%s}Data' % TT
+SIMPLE_ITEM = '{%s}SimpleItem' % TT
+SUBSCRIPTION_REFERENCE = '{%s}SubscriptionReference' % TEV
+CURRENT_TIME = '{%s}CurrentTime' % TEV
+TERMINATION_TIME = '{%s}TerminationTime' % TEV
+WSNT_CURRENT_TIME = '{%s}CurrentTime' % WSNT
+WSNT_TERMINATION_TIME = '{%s}TerminationTime' % WSNT
+NOTIFICATION_MESSAGE = '{%s}NotificationMessage' % WSNT
+TOPIC = '{%s}Topic' % WSNT
+MESSAGE = '{%s}Message' % TT
+SOURCE = '{%s}Source' % TT
+ADDRESS = '{%s}Address' % WSA
+RULE = '{%s}Rule' % TAN
+
+
+def parse(content):
+    """
+    Parse XML response
+    :param content: bytes of the response
+    :return: xml.etree.ElementTree.Element - root element
+    """
+    return ET.fromstring(content)
+
+
+def fault_text(content):
+    """
+    :param content: bytes of the response
+    :return: Text of the SOAP fault or None if the response is not a SOAP fault
+    """
+    try:
+        root = parse(content)
+    except ET.ParseError:
+        return None
+    return find_text(root, FAULT_TEXT)
+
+
+def fault_codes(content):
+    """
+    :param content: bytes of the response
+    :return: Set of the fault names without prefix: values of Code and Subcode and elements of Detail,
+    i.e. {'Sender', 'InvalidTopicExpressionFault'}, empty if the response is not a SOAP fault
+    """
+    try:
+        root = parse(content)
+    except ET.ParseError:
+        return set()
+    codes = set()
+    code = find(root, FAULT_CODE)
+    if code is not None:
+        codes.update((i.text or '').strip().rpartition(':')[2] for i in code.iter(FAULT_VALUE))
+    detail = find(root, FAULT_DETAIL)
+    if detail is not None:
+        codes.update(i.tag.rpartition('}')[2] for i in detail)
+    codes.discard('')
+    return codes
+
+
+def local_name(name):
+    """
+    Name without namespace in lower case, as the names of html.parser
+    :param name: Tag or attribute name {namespace}Name
+    :return: name
+    """
+    return name.rpartition('}')[2].lower()
+
+
+def find(root, tag):
+    """
+    First element by name at any depth
+    :param root: Element
+    :param tag: Name in Clark notation
+    :return: Element or None
+    """
+    return next(root.iter(tag), None)
+
+
+def find_all(root, tag):
+    """
+    :param root: Element
+    :param tag: Name in Clark notation
+    :return: [Element, ...] at any depth
+    """
+    return list(root.iter(tag))
+
+
+def find_text(root, tag):
+    """
+    :param root: Element
+    :param tag: Name in Clark notation
+    :return: Text of the first element or None
+    """
+    element = find(root, tag)
+    return None if element is None else (element.text or '')
+
+
+def attributes(element):
+    """
+    :param element: Element
+    :return: {name: value} with names without namespace in lower case
+    """
+    return {local_name(k): v for k, v in element.attrib.items()}
+
+
+def first_child(element):
+    """
+    :param element: Element
+    :return: First child element or None
+    """
+    return next(iter(element), None)
+
+
+def to_dict(element):
+    """
+    Nested dictionary of element: {name: text} for elements without children,
+    {name: {child name: ...}} otherwise. Names are without namespace in lower case.
+    :param element: Element
+    :return: dict
+    """
+    if len(element) == 0:
+        return {local_name(element.tag): element.text or ''}
+    result = {}
+    for child in element:
+        result.update(to_dict(child))
+    return {local_name(element.tag): result}
+
+
+def prettify(root):
+    """
+    :param root: Element
+    :return: Indented XML string
+    """
+    if hasattr(ET, 'indent'):  # Python 3.9
+        ET.indent(root)
+    return ET.tostring(root, encoding='unicode')
@@ -5,11 +5,13 @@ import logging
 import os
 import sys
 import time
-from multiprocessing import Process, Event
+from multiprocessing import Event, Pipe, Process
 
 from pgoogledrive import GoogleDrive
-from ponvif import OnvifCam
+from ponvif import OnvifCam, open_cameras
 from prtsp import RecordRTSP
+from psnapshot import SnapshotPipeline
+from psupervisor import Supervisor
 
 
 def get_config():
@@ -57,6 +59,23 @@ def logs_setup(config):
     log_motion.addHandler(handler)
     return log_motion
 
+def make_snapshot_pipeline(cam, config, drive, clean=False):
+    """
+    Snapshots of motion events by the policy of [Record] settings
+    :param cam: OnvifCam
+    :param config: dict settings of [Record]
+    :param drive: GoogleDrive
+    :param clean: Remove snapshots after upload
+    :return: SnapshotPipeline
+    """
+    interval = config.get('snapshot_interval')  # Seconds between snapshots of motion event, 0 - only the first
+    best_of = config.get('snapshot_best_of')  # Snapshots taken for one, the most detailed is stored
+    max_event = config.get('snapshot_max')  # Maximum snapshots of motion event, 0 - unlimited
+    return SnapshotPipeline(cam, config['dir_snapshots'], drive, clean,
+                            interval=float(interval) if interval else 5,
+                            best_of=int(best_of) if best_of else 1,
+                            max_event=int(max_event) if max_event else 0)
+
 def record_motion():
     config = get_config()
     log_motion = logs_setup(config['Log'])
@@ -68,46 +87,32 @@ def record_motion():
     cam.synchronization_date_time()
 
     drive = GoogleDrive(config['GoogleDrive'])
+    snapshots = make_snapshot_pipeline(cam, record_conf, drive)
 
     record = RecordRTSP(record_conf)
     stop_record = Event()
-    start_record = Event()
-    proc = Process(target=record.run_record_with_prebuffer, args=(start_record, stop_record))
+    trigger, motion_sender = Pipe(duplex=False)
+    proc = Process(target=record.run_record_with_prebuffer, args=(trigger, stop_record))
     proc.daemon = True
     proc.start()
 
     last_motion = False
-    rec = False
-    stop_time_record = None
-    min_duration = int(record_conf['rec_before_motion']) + int(record_conf['rec_after_motion'])
     try:
-        for i in cam.run_detect_motion():
-            if i:
-                motion = True
-                log_motion.info('Motion True')
-                snapshot = cam.save_snapshot(record_conf['dir_snapshots'])
-                if snapshot:
-                    drive.upload(snapshot)
-            else:
-                motion = False
-            if motion and not rec:
-                start_record.set()
-                rec = True
-            elif motion and rec:
-                stop_time_record = None
-            elif not motion and rec:
-                if last_motion:
-                    stop_time_record = time.time()
-                if time.time() - min_duration > stop_time_record:
-                    rec = False
-                    start_record.clear()
+        for motion in cam.run_detect_motion():
+            if motion != last_motion:  # Post-record is handled by the recorder
+                motion_sender.send((motion, time.time()))
             last_motion = motion
+            if motion:
+                log_motion.info('Motion True')
+            snapshots.motion(motion)  # Fetched and uploaded on the threads of the pipeline
     except:
         logging.error("{}: {}".format((__name__), sys.exc_info()[0]))
         pass
     finally:
         stop_record.set()
+        snapshots.stop()
         proc.join()
+        logging.warning("Motion latency: {}".format(cam.motion_latency))
 
 def record_online():
     config = get_config()
@@ -130,38 +135,84 @@ def record_online():
     finally:
         proc.join()
 
+def get_cameras(config):
+    """
+    Cameras of sections [Camera <name>], settings of [Record] are common for all cameras.
+    Stream url is 'rtsp_url' of the section or is requested by ONVIF.
+    :param config: dict settings from config.ini
+    :return: {name: settings of RecordRTSP}
+    """
+    cameras = {}
+    onvif = {}
+    for section, settings in config.items():
+        if not section.startswith('Camera '):
+            continue
+        name = section.split(None, 1)[1].strip()
+        camera = dict(config['Record'])
+        camera.update(settings)
+        cameras[name] = camera
+        if not camera.get('rtsp_url'):
+            onvif[name] = settings
+    onvif_cams = open_cameras(onvif, stream_uri=True)  # All cameras at once
+    for name in onvif:
+        if name in onvif_cams:
+            cameras[name]['rtsp_url'] = onvif_cams[name].get_stream_uri()
+        else:  # Logged by open_cameras
+            del cameras[name]
+    return cameras
+
+def record_cameras():
+    """
+    Online record of all cameras [Camera <name>] on worker processes (see psupervisor)
+    """
+    config = get_config()
+    logs_setup(config['Log'])
+    cameras = get_cameras(config)
+    if not cameras:
+        logging.error("No cameras: add sections [Camera <name>] to config.ini")
+        return
+    workers = config['Record'].get('workers')  # Worker processes, number of cores by default
+    supervisor = Supervisor(cameras, int(workers) if workers else None)
+    stop_record = Event()
+    try:
+        supervisor.run(stop_record)
+    except KeyboardInterrupt:
+        stop_record.set()
+
 def upload_snapshots(clean_snapshot=True):
     config = get_config()
     log_motion = logs_setup(config['Log'])
     drive = GoogleDrive(config['GoogleDrive'])
     cam=OnvifCam(config['Camera'])
     cam.synchronization_date_time()
+    snapshots = make_snapshot_pipeline(cam, config['Record'], drive, clean_snapshot)
     try:
         for i in cam.run_detect_motion():
             if i:
                 log_motion.info('Motion True')
-                snapshot = cam.save_snapshot(config['Record']['dir_snapshots'])
-                drive.upload(snapshot)
-                if clean_snapshot:
-                    os.remove(snapshot)
+            snapshots.motion(i)
     except KeyboardInterrupt:
         pass
     except:
         logging.error("{}: {}".format((__name__), sys.exc_info()[0]))
+    finally:
+        snapshots.stop()
+        logging.warning("Motion latency: {}".format(cam.motion_latency))
 
 
 if __name__ == "__main__":
     print('Change record:\n'
           '  Online record: 1\n'
           '  Detect motion record: 2\n'
-          '  Save snapshots on google drive: 3')
+          '  Save snapshots on google drive: 3\n'
+          '  Online record of all cameras: 4')
     while True:
         s = input('> ')
         try:
             count = int(s)
             break
         except ValueError:
-            print('Enter 1 or 2')
+            print('Enter 1, 2, 3 or 4')
     if count == 1:
         print('Stop record: CTRL + C')
         record_online()
@@ -171,5 +222,8 @@ if __name__ == "__main__":
     elif count == 3:
         print('Stop record: CTRL + C')
         upload_snapshots()
+    elif count == 4:
+        print('Stop record: CTRL + C')
+        record_cameras()
     else:
         print('Wrong input')
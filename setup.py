@@ -21,8 +21,6 @@ setup(
     url=URL,
     packages=find_packages(),
     install_requires=[
-        "bitstring==3.1.5",
-        "bs4==0.0.1",
         "google-api-python-client==1.5.3",
         "oauth2client==3.0.0",
         "requests==2.10.0",